@@ -0,0 +1,184 @@
+### Imports ###
+import numpy as np
+import hashlib
+import threading
+
+### Constants ###
+# ENVI data type codes -> numpy types
+envi_dtypes = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32, 5: np.float64,
+               6: np.complex64, 9: np.complex128, 12: np.uint16, 13: np.uint32,
+               14: np.int64, 15: np.uint64}
+
+### Settings ###
+cache_size = 64 # parsed headers kept in memory
+
+### Global Variables ###
+header_cache = dict() # header file hash -> EnviHeader, see read_header
+cache_lock = threading.Lock()
+
+### Parsing ###
+
+class EnviHeader():
+    """Fields of an ENVI header (.hdr) as typed attributes: samples (positions
+    per frame), lines (frames, 0 if not given), bands, interleave ("bil",
+    "bip" or "bsq"), dtype (numpy type of the data including its byte
+    order), byte_order, header_offset (bytes before the data), wavelength
+    (float32 array, None if not given), wavelength_units, exposure (None if
+    not given), with every field as text in fields and the ";" comment lines
+    the Headwall software appends in comments"""
+
+    def __init__(self, fields, comments=None, key=None):
+        """Input: fields: dict of lower case field name -> text, or list of
+                text for {} lists, comments: the same for comment lines,
+                key: hash of the header file"""
+        missing = [name for name in ("samples", "bands", "data type") if name not in fields]
+        if missing:
+            raise ValueError(f"ENVI header is missing {missing}")
+        self.fields = fields
+        self.comments = dict() if comments is None else comments
+        self.key = key
+
+        self.samples = int(fields["samples"])
+        self.lines = int(fields.get("lines", 0))
+        self.bands = int(fields["bands"])
+        self.header_offset = int(fields.get("header offset", 0))
+        self.interleave = fields.get("interleave", "bsq").lower()
+        if self.interleave not in ("bil", "bip", "bsq"):
+            raise ValueError(f"Unknown ENVI interleave {self.interleave}")
+        self.byte_order = int(fields.get("byte order", 0))
+        code = int(fields["data type"])
+        if code not in envi_dtypes:
+            raise ValueError(f"Unsupported ENVI data type {code}")
+        self.dtype = np.dtype(envi_dtypes[code]).newbyteorder(">" if self.byte_order else "<")
+
+        self.wavelength = None
+        if "wavelength" in fields:
+            self.wavelength = np.array(fields["wavelength"], dtype=np.float32)
+            if len(self.wavelength) != self.bands:
+                raise ValueError(f"ENVI header lists {len(self.wavelength)} wavelengths "
+                                 f"for {self.bands} bands")
+        self.wavelength_units = fields.get("wavelength units")
+        self.exposure = find_number(("exposure", "integration time"), fields, self.comments)
+
+    @property
+    def shape(self):
+        """(lines, samples, bands) shape of the image"""
+        return (self.lines, self.samples, self.bands)
+
+    @property
+    def frame_bytes(self):
+        """Bytes of one line (frame) of a bil or bip image"""
+        return self.samples * self.bands * self.dtype.itemsize
+
+    @property
+    def wavelength_key(self):
+        """Hash of the wavelengths and their units, shared by every header
+        with the same bands"""
+        digest = hashlib.sha1(str(self.wavelength_units).encode())
+        if self.wavelength is not None:
+            digest.update(self.wavelength.tobytes())
+        return digest.hexdigest()
+
+def find_number(names, *sources):
+    """Input: names: parts of field names to look for, sources: dicts of
+            fields, searched in turn
+    Output: the leading number of the first matching field, None if no field
+            matches"""
+    for source in sources:
+        for field, value in source.items():
+            if any(name in field for name in names) and isinstance(value, str):
+                try:
+                    return float(value.split()[0])
+                except (IndexError, ValueError):
+                    continue
+    return None
+
+def parse_header(text, key=None):
+    """Parses the text of an ENVI header. Fields are "name = value" lines,
+    with {} values split on commas and allowed to span lines, and lines
+    starting with ";" are comments, parsed the same way when they hold a
+    field
+    Input: header text, key: hash of the header file
+    Output: EnviHeader"""
+    lines = text.splitlines()
+    if len(lines) == 0 or lines[0].strip() != "ENVI":
+        raise ValueError("Not an ENVI header")
+    fields, comments = dict(), dict()
+    i = 1
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        target = fields
+        if line.startswith(";"):
+            target, line = comments, line[1:]
+        if "=" not in line:
+            continue
+        name, value = (part.strip() for part in line.split("=", 1))
+        if value.startswith("{"):
+            while "}" not in value and i < len(lines):
+                value += "\n" + lines[i].strip()
+                i += 1
+            value = value[1:value.rfind("}")] if "}" in value else value[1:]
+            if name.lower() != "description":
+                value = [item.strip() for item in value.split(",")]
+        target[name.lower()] = value
+    return EnviHeader(fields, comments, key)
+
+def read_header(path):
+    """Reads an ENVI header, parsing it only the first time a header with
+    these exact contents is seen
+    Input: path of the .hdr file
+    Output: EnviHeader"""
+    with open(path, "rb") as file:
+        return header_from_bytes(file.read())
+
+def header_from_bytes(data):
+    """Parses the contents of an ENVI header, only the first time a header 
+    with these exact contents is seen
+    Input: bytes of the .hdr file
+    Output: EnviHeader"""
+    key = hashlib.sha1(data).hexdigest()
+    with cache_lock:
+        if key in header_cache:
+            header_cache[key] = header_cache.pop(key) # most recently used last
+            return header_cache[key]
+
+    header = parse_header(data.decode("latin-1"), key)
+    with cache_lock:
+        header_cache[key] = header
+        while len(header_cache) > cache_size:
+            header_cache.pop(next(iter(header_cache)))
+    return header
+
+### Image Access ###
+
+def stored_shape(header):
+    """Output: shape of the image's data in file order"""
+    return {"bil": (header.lines, header.bands, header.samples),
+            "bip": (header.lines, header.samples, header.bands),
+            "bsq": (header.bands, header.lines, header.samples)}[header.interleave]
+
+def as_image(header, data):
+    """Input: EnviHeader, data in file order (see stored_shape)
+    Output: (lines, samples, bands) view of the data"""
+    return data.transpose({"bil": (0, 2, 1), "bip": (0, 1, 2),
+                           "bsq": (1, 2, 0)}[header.interleave])
+
+def memmap_image(header_path, data_path):
+    """Memory-maps an ENVI image as described by its header
+    Input: paths of the .hdr file and of the data
+    Output: read only (lines, samples, bands) view of the data on disk"""
+    header = read_header(header_path)
+    data = np.memmap(data_path, dtype=header.dtype, mode="r",
+                     offset=header.header_offset, shape=stored_shape(header))
+    return as_image(header, data)
+
+def image_from_bytes(header_data, data):
+    """Decodes an ENVI image held in memory without copying it
+    Input: bytes of the .hdr file and of the data
+    Output: read only (lines, samples, bands) view of the data"""
+    header = header_from_bytes(header_data)
+    shape = stored_shape(header)
+    flat = np.frombuffer(data, dtype=header.dtype, count=int(np.prod(shape)),
+                         offset=header.header_offset)
+    return as_image(header, flat.reshape(shape))
@@ -0,0 +1,126 @@
+### Imports ###
+import numpy as np
+import json
+import struct
+import zlib
+
+### Settings ###
+magic = b"HSPR" # first bytes of every payload
+format_version = 1
+compression_level = 6 # zlib level, results are small so this is cheap
+suffix = ".hspr" # file extension of saved payloads
+quantized_max = 65534 # largest scaled uint16 value, 65535 marks non finite values
+scaled_maps = ("T",) # float maps stored as scaled uint16; the fitted emissivity
+                     # terms span decades, so the rest keep their dtype
+
+### Encoding ###
+# A payload is magic, the format version (uint16) and the header length
+# (uint32), little endian, then a JSON header and the zlib compressed body.
+# The header gives the map shape and, for every map in body order, its name,
+# stored dtype, encoding ("scaled", "masked" or "raw") and for "scaled" maps 
+# the offset and scale, so that value = offset + scale * stored. Float maps 
+# hold zeros at the invalid pixels, which compress to almost nothing. The 
+# body starts with the validity bitmask (np.packbits of the valid pixels, row
+# major), followed by the maps
+
+def encode(maps, valid=None, scaled=None):
+    """Encodes fit maps without pickling anything. The scaled maps are 
+    stored as uint16 spread over their finite values at the valid pixels,
+    other maps in their own dtype; float values at invalid pixels are not 
+    kept
+    Input: maps: dict of name -> (frames, positions) map, e.g. from
+            temperature_analysis.result_arrays, valid: boolean map of the
+            pixels holding usable values, None for maps["status"] >= 0,
+            scaled: names of the float maps to scale, None for scaled_maps
+    Output: payload bytes"""
+    scaled = scaled_maps if scaled is None else scaled
+    if valid is None:
+        valid = np.asarray(maps["status"]) >= 0
+    valid = np.asarray(valid, dtype=bool)
+    shape = valid.shape
+    entries, parts = [], [np.packbits(valid, axis=None).tobytes()]
+    for name, values in maps.items():
+        values = np.asarray(values)
+        if values.shape != shape:
+            raise ValueError(f"Map {name} has shape {values.shape}, expected {shape}")
+        entry = {"name": name, "dtype": values.dtype.newbyteorder("<").str}
+        if values.dtype.kind == "f" and name in scaled:
+            finite = valid & np.isfinite(values)
+            low = float(values[finite].min()) if finite.any() else 0.0
+            high = float(values[finite].max()) if finite.any() else 0.0
+            scale = (high - low) / quantized_max if high > low else 1.0
+            stored = np.zeros(shape, dtype="<u2")
+            stored[finite] = np.rint((values[finite] - low) / scale).astype(np.uint16)
+            stored[valid & ~finite] = quantized_max + 1
+            entry.update({"encoding": "scaled", "stored": "<u2", "offset": low, "scale": scale})
+        elif values.dtype.kind == "f":
+            stored = np.where(valid, values, 0).astype(entry["dtype"])
+            entry.update({"encoding": "masked", "stored": entry["dtype"]})
+        else:
+            stored = values.astype(entry["dtype"])
+            entry.update({"encoding": "raw", "stored": entry["dtype"]})
+        entries.append(entry)
+        parts.append(np.ascontiguousarray(stored).tobytes())
+
+    header = json.dumps({"version": format_version, "shape": list(shape),
+                         "maps": entries}).encode()
+    body = zlib.compress(b"".join(parts), compression_level)
+    return magic + struct.pack("<HI", format_version, len(header)) + header + body
+
+def is_payload(data):
+    """Output: whether the bytes start like a payload"""
+    return bytes(data[:len(magic)]) == magic
+
+def decode(data, names=None):
+    """Input: payload bytes from encode, names: maps to decode, None for
+            every map
+    Output: dict of name -> map, with float maps NaN at the invalid pixels
+            and the boolean validity map as "valid" """
+    if not is_payload(data):
+        raise ValueError("Not a result payload")
+    start = len(magic)
+    version, header_length = struct.unpack_from("<HI", data, start)
+    if version > format_version:
+        raise ValueError(f"Result payload format {version} is newer than {format_version}")
+    start += struct.calcsize("<HI")
+    header = json.loads(bytes(data[start:start + header_length]).decode())
+    body = zlib.decompress(data[start + header_length:])
+
+    shape = tuple(header["shape"])
+    pixels = int(np.prod(shape))
+    valid = np.unpackbits(np.frombuffer(body, dtype=np.uint8, count=-(-pixels // 8)),
+                          count=pixels).astype(bool).reshape(shape)
+    position = -(-pixels // 8)
+    maps = {"valid": valid}
+    for entry in header["maps"]:
+        stored_dtype = np.dtype(entry["stored"])
+        stored = np.frombuffer(body, dtype=stored_dtype, count=pixels,
+                               offset=position).reshape(shape)
+        position += pixels * stored_dtype.itemsize
+        if names is not None and entry["name"] not in names:
+            continue
+        if entry["encoding"] == "scaled":
+            values = np.full(shape, np.nan, dtype=np.dtype(entry["dtype"]).newbyteorder("="))
+            values[valid] = entry["offset"] + entry["scale"] * stored[valid]
+            values[valid & (stored > quantized_max)] = np.nan
+        elif entry["encoding"] == "masked":
+            values = np.where(valid, stored, np.nan).astype(stored_dtype.newbyteorder("="))
+        elif entry["encoding"] == "raw":
+            values = stored.astype(stored_dtype.newbyteorder("="))
+        else:
+            raise ValueError(f"Unknown encoding {entry['encoding']} of map {entry['name']}")
+        maps[entry["name"]] = values
+    return maps
+
+def save(path, maps, valid=None):
+    """Input: output path, maps, valid: as in encode
+    Output: the path written"""
+    with open(path, "wb") as file:
+        file.write(encode(maps, valid))
+    return path
+
+def load(path, names=None):
+    """Input: path of a file written by save, names: as in decode
+    Output: dict of its maps, as from decode"""
+    with open(path, "rb") as file:
+        return decode(file.read(), names)
@@ -0,0 +1,169 @@
+### Imports ###
+import numpy as np
+import os
+import json
+import zlib
+
+### Settings ###
+chunk_frames = 32 # frames per chunk, so a block of frames is read from one row of chunks
+chunk_bands = 64 # bands per chunk of a (frames, positions, bands) cube
+compression_level = 1 # zlib level, low since chunks are written while captures stream in
+format_version = 1
+
+### Archive ###
+
+class Archive():
+    """Directory of captures keyed by their timestamp (the capture folder's
+    name, e.g. 2024_07_25_09_16_16), each holding named arrays such as the
+    corrected cube and the fit maps of save_result. Every array is stored as
+    a directory of zlib compressed chunks of whole positions, chunk_frames
+    frames long and, for cubes, chunk_bands bands wide, plus a meta.json
+    giving its shape, dtype, chunking and attributes; reading a window of
+    frames and bands only decompresses the chunks it overlaps"""
+
+    def __init__(self, root):
+        """Input: root directory of the archive, created when first written"""
+        self.root = str(root)
+
+    def path(self, timestamp, name=None):
+        """Output: directory of a capture, or of one of its arrays"""
+        for part in (timestamp, name):
+            if part is not None and (part in ("", ".", "..") or "/" in part or os.sep in part):
+                raise ValueError(f"Invalid archive key {part!r}")
+        if name is None:
+            return os.path.join(self.root, timestamp)
+        return os.path.join(self.root, timestamp, name)
+
+    def timestamps(self, start=None, end=None):
+        """Input: start, end: range of timestamps to list, inclusive, None
+                for no bound
+        Output: sorted timestamps of the archived captures"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(entry for entry in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, entry))
+                      and (start is None or entry >= start) and (end is None or entry <= end))
+
+    def names(self, timestamp):
+        """Output: sorted names of the complete arrays of a capture"""
+        directory = self.path(timestamp)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(entry for entry in os.listdir(directory)
+                      if os.path.isfile(os.path.join(directory, entry, "meta.json")))
+
+    def meta(self, timestamp, name):
+        """Output: dict of an array's shape, dtype, chunks and attrs"""
+        with open(os.path.join(self.path(timestamp, name), "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta["version"] > format_version:
+            raise ValueError(f"Archive format {meta['version']} is newer than {format_version}")
+        return meta
+
+    def write(self, timestamp, name, data, frames_per_chunk=None, bands_per_chunk=None,
+              attrs=None):
+        """Writes an array a row of chunks at a time, so data can be a
+        LazyCapture that is never held in memory whole
+        Input: capture timestamp, array name, data: (frames, positions) or
+                (frames, positions, bands) array, or anything with shape,
+                dtype and frame slicing, frames_per_chunk, bands_per_chunk:
+                chunking, None for chunk_frames and chunk_bands, attrs:
+                JSON serializable dict to keep with the array
+        Output: the array's directory"""
+        shape = tuple(int(n) for n in data.shape)
+        dtype = np.dtype(getattr(data, "dtype", np.float32))
+        frames_per_chunk = chunk_frames if frames_per_chunk is None else frames_per_chunk
+        if len(shape) == 3:
+            bands_per_chunk = chunk_bands if bands_per_chunk is None else bands_per_chunk
+        else:
+            bands_per_chunk = None
+        directory = self.path(timestamp, name)
+        os.makedirs(directory, exist_ok=True)
+        # Rewriting an array invalidates it until its new meta.json is written
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        for i, start in enumerate(range(0, shape[0], frames_per_chunk)):
+            block = np.asarray(data[start:start + frames_per_chunk], dtype=dtype)
+            band_starts = [None] if bands_per_chunk is None else range(0, shape[2], bands_per_chunk)
+            for j, band_start in enumerate(band_starts):
+                piece = block if band_start is None else block[..., band_start:band_start + bands_per_chunk]
+                with open(os.path.join(directory, f"{i}.{j}"), "wb") as file:
+                    file.write(zlib.compress(np.ascontiguousarray(piece).tobytes(),
+                                             compression_level))
+
+        meta = {"version": format_version, "shape": shape, "dtype": dtype.str,
+                "chunks": [frames_per_chunk, bands_per_chunk],
+                "attrs": dict() if attrs is None else attrs}
+        with open(meta_path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(meta_path + ".tmp", meta_path)
+        return directory
+
+    def read(self, timestamp, name, frames=None, positions=None, bands=None):
+        """Reads a window of an array
+        Input: capture timestamp, array name, frames, positions, bands:
+                slices of each axis to read, None for all of it
+        Output: the window as an array"""
+        meta = self.meta(timestamp, name)
+        shape, dtype = tuple(meta["shape"]), np.dtype(meta["dtype"])
+        frames_per_chunk, bands_per_chunk = meta["chunks"]
+        directory = self.path(timestamp, name)
+        f0, f1, _ = (frames or slice(None)).indices(shape[0])
+        f1 = max(f1, f0)
+        positions = positions or slice(None)
+        out_shape = (f1 - f0, len(range(*positions.indices(shape[1]))))
+        b0, b1 = 0, 1
+        if len(shape) == 3:
+            b0, b1, _ = (bands or slice(None)).indices(shape[2])
+            b1 = max(b1, b0)
+            out_shape += (b1 - b0,)
+        out = np.empty(out_shape, dtype=dtype)
+
+        for i in range(f0 // frames_per_chunk, -(-f1 // frames_per_chunk)):
+            c0 = i * frames_per_chunk
+            rows = min(frames_per_chunk, shape[0] - c0)
+            r0, r1 = max(f0, c0), min(f1, c0 + rows)
+            if bands_per_chunk is None:
+                chunks = [(0, 0, shape[1:])]
+            else:
+                chunks = [(j, j * bands_per_chunk,
+                           (shape[1], min(bands_per_chunk, shape[2] - j * bands_per_chunk)))
+                          for j in range(b0 // bands_per_chunk, -(-b1 // bands_per_chunk))]
+            for j, d0, chunk_shape in chunks:
+                with open(os.path.join(directory, f"{i}.{j}"), "rb") as file:
+                    chunk = np.frombuffer(zlib.decompress(file.read()), dtype=dtype)
+                chunk = chunk.reshape((rows,) + tuple(chunk_shape))[r0 - c0:r1 - c0][:, positions]
+                if bands_per_chunk is None:
+                    out[r0 - f0:r1 - f0] = chunk
+                    continue
+                e0, e1 = max(b0, d0), min(b1, d0 + chunk_shape[1])
+                out[r0 - f0:r1 - f0, :, e0 - b0:e1 - b0] = chunk[..., e0 - d0:e1 - d0]
+        return out
+
+    def write_maps(self, timestamp, maps, attrs=None):
+        """Input: capture timestamp, dict of name -> (frames, positions) map,
+                e.g. from result_arrays, attrs: kept with every map"""
+        for name, values in maps.items():
+            self.write(timestamp, name, np.asarray(values), attrs=attrs)
+
+    def read_maps(self, timestamp, names=None, frames=None, positions=None):
+        """Input: capture timestamp, names of the maps to read, None for
+                every array but the cube, frames, positions: window to read
+        Output: dict of name -> map"""
+        names = [name for name in self.names(timestamp) if name != "cube"] if names is None else names
+        return {name: self.read(timestamp, name, frames, positions) for name in names}
+
+    def timeline(self, name, frames=None, positions=None, bands=None, start=None, end=None):
+        """Reads the same window of an array from every capture that has it,
+        e.g. the temperature of one region over a growth
+        Input: array name, frames, positions, bands: window as in read,
+                start, end: range of timestamps as in timestamps
+        Output: (list of timestamps, list of their windows)"""
+        stamps, windows = [], []
+        for timestamp in self.timestamps(start, end):
+            if name in self.names(timestamp):
+                stamps.append(timestamp)
+                windows.append(self.read(timestamp, name, frames, positions, bands))
+        return stamps, windows
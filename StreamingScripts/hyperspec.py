@@ -12,6 +12,7 @@ from openmsistream import (
     DataFileStreamProcessor,
     MetadataJSONReproducer,
 )
+import result_payload
 
 
 
@@ -59,7 +60,7 @@ def upload_task(upload_directory, *args, **kwargs):
     upload_directory.logger.info(msg)
 
 class PlaceholderStreamProcessor(DataFileStreamProcessor):
-    """Saves the returned temperature array as well as a heatmap plot of it
+    """Saves the returned fit results as well as a heatmap plot of their temperatures
     """
 
     def _process_downloaded_data_file(self, datafile, lock):
@@ -67,15 +68,27 @@ class PlaceholderStreamProcessor(DataFileStreamProcessor):
             # construct output paths
             rel_filepath = datafile.relative_filepath
             rel_fp_str = str(rel_filepath.as_posix()).replace("/","_").replace(".","_")
-            output_filepath = self._output_dir / f"{rel_fp_str}_result.npy"
+            data = datafile.bytestring
+
+            # Results come as compact payloads (see result_payload.py), or as
+            # .npz files from older processors
+            if result_payload.is_payload(data):
+                output_filepath = self._output_dir / f"{rel_fp_str}_result{result_payload.suffix}"
+            else:
+                output_filepath = self._output_dir / f"{rel_fp_str}_result.npz"
 
             with lock:
-                # download the incoming numpy array file
+                # keep the incoming result file
                 with open(output_filepath, "wb") as filep:
-                    filep.write(BytesIO(datafile.bytestring).read())
-
-            # load the array and save a thermal gradient plot
-            temp_arr = np.load(output_filepath, allow_pickle=True)
+                    filep.write(data)
+
+            # decode the fit maps straight from the message and save a thermal
+            # gradient plot of the pixels that were fitted successfully
+            if result_payload.is_payload(data):
+                temp_arr = result_payload.decode(data, names=("T",))["T"]
+            else:
+                with np.load(BytesIO(data), allow_pickle=False) as result:
+                    temp_arr = np.where(result["status"] >= 0, result["T"], np.nan)
             plt.figure()
             plt.imshow(temp_arr, cmap="hot")
             plt.colorbar()
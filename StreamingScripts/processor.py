@@ -1,9 +1,11 @@
 ########## Imports ##########
 
 import numpy as np
-from time import sleep
-import pathlib, importlib, logging, datetime, json, platform
-from threading import Thread
+from time import sleep, monotonic, time
+import os, pathlib, importlib, logging, datetime, json, platform, sqlite3
+from threading import Thread, RLock, Lock, Condition, Timer
+from collections import OrderedDict
+from queue import Queue
 from openmsitoolbox.logging import OpenMSILogger
 from openmsistream import (
     DataFileDownloadDirectory,
@@ -12,49 +14,278 @@ from openmsistream import (
     UploadDataFile,
 )
 import temperature_analysis
+import archive
+import result_payload
 
 
 
 ########## File Tracking ##########
 
+# Files a capture folder needs before it can be analyzed, one bit each
+REQUIRED_FILES = (
+    "whiteReference",
+    "whiteReference.hdr",
+    "darkReference",
+    "darkReference.hdr",
+    "data",
+    "data.hdr",
+    "raw",
+    "raw.hdr",
+    "frameIndex.txt",
+)
+FILE_BITS = {filename: 1 << i for i, filename in enumerate(REQUIRED_FILES)}
+ALL_FILES = (1 << len(REQUIRED_FILES)) - 1
+
+# Files the analysis reads, kept in memory as they arrive in memory mode
+ANALYZED_FILES = (
+    "whiteReference",
+    "whiteReference.hdr",
+    "darkReference",
+    "darkReference.hdr",
+    "raw",
+    "raw.hdr",
+)
+
 class FolderTracker():
+    __slots__ = ("arrived", "analyzed", "queued", "analyzing", "failures", "last_seen", 
+                 "files", "released")
+
     def __init__(self):
+        self.arrived = 0 # bitmask of the REQUIRED_FILES seen so far
         self.analyzed = False
-        self.dict = {
-            "whiteReference": False,
-            "whiteReference.hdr": False,
-            "darkReference": False,
-            "darkReference.hdr": False,
-            "data": False,
-            "data.hdr": False,
-            "raw": False,
-            "raw.hdr": False,
-            "frameIndex.txt": False
-        }
-
-    def update(self, filename):
-        if filename in self.dict.keys(): self.dict[filename] = True
+        self.queued = False
+        self.analyzing = False # whether an analysis thread is using the files
+        self.failures = 0 # failed analyses since the last successful one
+        self.last_seen = monotonic()
+        self.files = None # filename -> contents of the ANALYZED_FILES received in memory
+        self.released = False # whether files were dropped, so the capture is read from disk
+
+    def update(self, filename, contents=None):
+        self.arrived |= FILE_BITS.get(filename, 0)
+        self.last_seen = monotonic()
+        if contents is not None and filename in ANALYZED_FILES and not self.released:
+            if self.files is None:
+                self.files = dict()
+            self.files[filename] = contents
+
+    def has_files(self):
+        "Whether every file the analysis reads is held in memory"
+        return self.files is not None and all(name in self.files for name in ANALYZED_FILES)
+
+    def files_bytes(self):
+        "Bytes of the files held in memory"
+        return 0 if self.files is None else sum(len(contents) for contents in self.files.values())
+
+    def release_files(self):
+        "Drops the files held in memory, returns how many bytes they took"
+        held = self.files_bytes()
+        self.files = None
+        self.released = True
+        return held
 
     def is_ready(self):
-        return (
-            self.dict["whiteReference"]
-            and self.dict["whiteReference.hdr"]
-            and self.dict["darkReference"]
-            and self.dict["darkReference.hdr"]
-            and self.dict["data"]
-            and self.dict["data.hdr"]
-            and self.dict["raw"]
-            and self.dict["raw.hdr"]
-            and self.dict["frameIndex.txt"]
-        )
+        return self.arrived == ALL_FILES
 
     def mark_analyzed(self):
         self.analyzed = True
+        self.queued = False
+        self.failures = 0
+        self.last_seen = monotonic()
     
     def is_analyzed(self):
         return self.analyzed
 
-GlobalTracker = dict()
+    def mark_failed(self):
+        self.failures += 1
+        self.last_seen = monotonic()
+
+    def is_failed(self):
+        "Whether the last analysis failed and no retry is queued"
+        return self.failures > 0 and not self.analyzed and not self.queued
+
+    def mark_queued(self, queued=True):
+        self.queued = queued
+        self.last_seen = monotonic()
+
+    def is_queued(self):
+        return self.queued
+
+    def mark_analyzing(self, analyzing=True):
+        self.analyzing = analyzing
+
+class TrackerStore():
+    """SQLite table of every capture folder's arrived files, analysis status 
+    ("arriving", "queued", "failed" or "analyzed") and result path, so a 
+    restarted processor neither forgets partly arrived captures nor analyzes
+    finished ones again. Analyzed folders stay as the index of results"""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, 
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS folders ("
+            "folder TEXT PRIMARY KEY, arrived INTEGER NOT NULL, status TEXT NOT NULL, "
+            "result TEXT, updated REAL NOT NULL)"
+        )
+
+    def load(self, folder):
+        "Returns (arrived bitmask, status, result path) of a folder, or None"
+        with self.lock:
+            return self.connection.execute(
+                "SELECT arrived, status, result FROM folders WHERE folder = ?", (folder,)
+            ).fetchone()
+
+    def save(self, folder, arrived, status, result=None):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO folders (folder, arrived, status, result, updated) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(folder) DO UPDATE SET "
+                "arrived = excluded.arrived, status = excluded.status, "
+                "result = COALESCE(excluded.result, folders.result), updated = excluded.updated",
+                (folder, arrived, status, result, time()),
+            )
+
+    def forget(self, folders):
+        "Drops unfinished folders, keeping analyzed ones in the index"
+        with self.lock:
+            self.connection.executemany(
+                "DELETE FROM folders WHERE folder = ? AND status != 'analyzed'",
+                [(folder,) for folder in folders],
+            )
+
+    def pending(self):
+        "Returns the folders that were queued or failed, but not analyzed"
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT folder FROM folders WHERE status IN ('queued', 'failed') "
+                "ORDER BY updated")]
+
+class TrackerRegistry():
+    """Thread-safe FolderTracker per capture folder, kept in least recently 
+    used order. Analyzed folders are forgotten analyzed_ttl seconds after 
+    their last file, so late or replayed messages are still ignored, and 
+    unfinished ones abandoned_ttl seconds after their last file; beyond 
+    max_folders the least recently used folder not waiting for analysis is
+    dropped. Files received in memory are held up to files_budget bytes in 
+    all, beyond which the least recently used folders release theirs, those
+    still arriving before those queued for analysis, while folders being 
+    analyzed keep theirs. With a TrackerStore, forgotten folders are 
+    looked up there and every change is saved to it. Hold lock to combine 
+    several calls into one step"""
+
+    def __init__(self, analyzed_ttl, abandoned_ttl, max_folders, store=None, 
+                 files_budget=None):
+        self.analyzed_ttl = analyzed_ttl
+        self.abandoned_ttl = abandoned_ttl
+        self.max_folders = max_folders
+        self.store = store
+        self.files_budget = files_budget
+        self.files_bytes = 0 # bytes of the files all trackers hold
+        self.lock = RLock()
+        self._trackers = OrderedDict()
+
+    def __len__(self):
+        return len(self._trackers)
+
+    def __contains__(self, folder):
+        return folder in self._trackers
+
+    def get(self, folder):
+        "Returns the folder's tracker, creating it if needed"
+        with self.lock:
+            tracker = self._trackers.get(folder)
+            if tracker is None:
+                tracker = self._trackers[folder] = FolderTracker()
+                saved = None if self.store is None else self.store.load(folder)
+                if saved is not None:
+                    tracker.arrived = saved[0]
+                    tracker.analyzed = saved[1] == "analyzed"
+                    tracker.queued = saved[1] == "queued"
+                    tracker.failures = int(saved[1] == "failed")
+                while len(self._trackers) > self.max_folders:
+                    self._evict_one()
+            self._trackers.move_to_end(folder)
+            return tracker
+
+    def update(self, folder, filename, contents=None):
+        """Records a file of the folder, holding its contents within 
+        files_budget, and returns the folder's tracker"""
+        with self.lock:
+            tracker = self.get(folder)
+            self.files_bytes -= tracker.files_bytes()
+            tracker.update(filename, contents)
+            self.files_bytes += tracker.files_bytes()
+            if self.files_budget is not None and self.files_bytes > self.files_budget:
+                # Least recently used first, so the folder just updated goes last
+                for queued in (False, True):
+                    for held in self._trackers.values():
+                        if self.files_bytes <= self.files_budget:
+                            break
+                        if (held.files is not None and held.is_queued() == queued 
+                                and not held.analyzing):
+                            self.files_bytes -= held.release_files()
+            return tracker
+
+    def release_files(self, folder):
+        "Drops the files the folder's tracker holds in memory"
+        with self.lock:
+            tracker = self._trackers.get(folder)
+            if tracker is not None:
+                self.files_bytes -= tracker.release_files()
+
+    def save(self, folder, result=None):
+        "Saves the folder's tracker to the store, with its result path if given"
+        if self.store is None:
+            return
+        with self.lock:
+            tracker = self.get(folder)
+            if tracker.is_analyzed():
+                status = "analyzed"
+            elif tracker.is_queued():
+                status = "queued"
+            else:
+                status = "failed" if tracker.is_failed() else "arriving"
+            self.store.save(folder, tracker.arrived, status, 
+                            None if result is None else str(result))
+
+    def resume(self):
+        """Returns the folders queued or failed when the processor last stopped,
+        marked queued again with their retries reset"""
+        if self.store is None:
+            return []
+        with self.lock:
+            folders = self.store.pending()
+            for folder in folders:
+                tracker = self.get(folder)
+                tracker.mark_queued()
+                tracker.failures = 0
+        return folders
+
+    def _evict_one(self):
+        for folder, tracker in self._trackers.items():
+            if not tracker.is_queued():
+                break
+        else:
+            folder = next(iter(self._trackers))
+        self.files_bytes -= self._trackers.pop(folder).files_bytes()
+
+    def expire(self):
+        "Forgets the analyzed and abandoned folders past their TTL, returns how many"
+        now = monotonic()
+        with self.lock:
+            expired = [
+                folder for folder, tracker in self._trackers.items()
+                if not tracker.is_queued() and now - tracker.last_seen > (
+                    self.analyzed_ttl if tracker.is_analyzed() else self.abandoned_ttl)
+            ]
+            for folder in expired:
+                self.files_bytes -= self._trackers.pop(folder).files_bytes()
+            if self.store is not None:
+                self.store.forget(expired)
+        return len(expired)
 
 
 
@@ -77,6 +308,65 @@ root_dir = pathlib.Path(".")
 CONFIG_FILE_PATH = root_dir / "paradim01_broker.config"
 STREAM_PROCESSOR_OUTPUT_DIR = root_dir / "hyperspec_LDFZ_data"
 
+# "memory" to assemble each capture's files from the received messages and
+# analyze them without reading them back from disk, "disk" to write every 
+# file out first and analyze it from there
+PROCESSOR_MODE = "memory"
+
+# In memory mode, also write the received files to STREAM_PROCESSOR_OUTPUT_DIR
+# from a background thread, off the analysis path, so interrupted analyses
+# can resume and the raw captures are kept. Captures whose files are not all
+# held in memory (some arrived before a restart, were released over 
+# TRACKER_FILES_BUDGET or after a failed analysis) are read back from there,
+# so without it they cannot be analyzed and nothing is resumed
+PERSIST_CAPTURES = True
+
+# Directory to archive every analyzed capture's corrected cube and fit maps
+# in, by timestamp (see archive.py); None to not archive
+ARCHIVE_DIR = None
+
+# Seconds analyzed and unfinished folders are remembered after their last 
+# file, the most folders remembered at once, and seconds between sweeps
+TRACKER_ANALYZED_TTL = 86400
+TRACKER_ABANDONED_TTL = 6 * 3600
+TRACKER_MAX_FOLDERS = 10000
+TRACKER_SWEEP_INTERVAL = 600
+
+# In memory mode, the most bytes of received files held for captures not yet
+# analyzed, including those queued; beyond it the least recently used 
+# captures drop theirs and are read from disk (see PERSIST_CAPTURES)
+TRACKER_FILES_BUDGET = 4 << 30
+
+# In memory mode, received files waiting to be written to disk before 
+# consumers block on receiving more (see PERSIST_CAPTURES)
+PERSIST_QUEUE_SIZE = 64
+
+# Database of folder arrivals, analyses and results, kept across restarts
+TRACKER_DB_PATH = STREAM_PROCESSOR_OUTPUT_DIR / "tracker.sqlite"
+STREAM_PROCESSOR_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+# White and dark references converted for correction, reused by captures
+# with identical ones and pruned to the most recently used few
+REFERENCE_CACHE_DIR = STREAM_PROCESSOR_OUTPUT_DIR / "reference_cache"
+REFERENCE_CACHE_FILES = 32
+temperature_analysis.reference_cache_dir = str(REFERENCE_CACHE_DIR)
+temperature_analysis.reference_cache_files = REFERENCE_CACHE_FILES
+
+GlobalTracker = TrackerRegistry(TRACKER_ANALYZED_TTL, TRACKER_ABANDONED_TTL, TRACKER_MAX_FOLDERS,
+                                store=TrackerStore(TRACKER_DB_PATH), 
+                                files_budget=TRACKER_FILES_BUDGET)
+
+# Threads analyzing captures, and captures that may wait for them before 
+# consumers block on queueing more
+ANALYSIS_WORKERS = 1
+ANALYSIS_QUEUE_SIZE = 16
+
+# Times a failed analysis is retried from the files on disk, and seconds 
+# before the first retry, doubling for each one after. A capture failing 
+# them all is saved as failed and retried when the processor restarts
+ANALYSIS_RETRIES = 3
+ANALYSIS_RETRY_DELAY = 60
+
 # root_dir = pathlib.Path("/home/nparik15/")
 # CONFIG_FILE_PATH = root_dir / "config_files" / "paradim01_broker.config"
 # STREAM_PROCESSOR_OUTPUT_DIR = root_dir / "hyperspec_LDFZ_data"
@@ -91,7 +381,7 @@ class ImageAnalysisProcessor(DataFileStreamProcessor):
     """
 
     def _process_downloaded_data_file(self, datafile, lock):
-        "Runs temperature analysis of image when all needed files have been streamed"
+        "Queues the image for analysis when all needed files have been streamed"
         try:
             # construct output paths
             rel_filepath = datafile.relative_filepath
@@ -100,28 +390,42 @@ class ImageAnalysisProcessor(DataFileStreamProcessor):
             folder = rel_fp_str[:rel_fp_str.rfind("/")]
             folderpath = str(self._output_dir / folder)
             file = rel_fp_str[rel_fp_str.rfind("/")+1:]
-            output_filepath = self._output_dir / folder / "result.npy"
+            output_filepath = self._output_dir / folder / f"result{result_payload.suffix}"
 
             print(folder, file)
 
-            with lock:
-                # check if all files have arrived 
-                # and that image has not already been analyzed
-                if folder not in GlobalTracker.keys():
-                    GlobalTracker[folder] = FolderTracker()
-
-                (GlobalTracker[folder]).update(file)
+            contents = datafile.bytestring if PROCESSOR_MODE == "memory" else None
 
-                if (GlobalTracker[folder]).is_analyzed():
-                    return None
-                if (GlobalTracker[folder]).is_ready():
-                    # perform analysis and upload result
-                    temp_arr = temperature_analysis.analysis(folderpath)
-                    np.save(output_filepath, temp_arr, allow_pickle=True)
-                    upload_file = UploadDataFile(output_filepath, rootdir=self._output_dir)
-                    upload_file.upload_whole_file(CONFIG_FILE_PATH, TOPIC_NAME)
-
-                    GlobalTracker[folder].mark_analyzed()
+            with GlobalTracker.lock:
+                # check if all files have arrived 
+                # and that image has not already been analyzed or queued
+                if GlobalTracker.get(folder).is_analyzed():
+                    contents = None # late or replayed file, nothing to keep
+                # Only files of captures still to be analyzed are written, and
+                # they count as pending before the capture can be queued
+                write = PERSIST_CAPTURES and contents is not None and file in FILE_BITS
+                if write:
+                    reserve_write(folder)
+                tracker = GlobalTracker.update(folder, file, contents)
+
+                queue = not (tracker.is_analyzed() or tracker.is_queued() or not tracker.is_ready())
+                if queue:
+                    tracker.mark_queued()
+                    # Without every analyzed file in memory (e.g. some arrived
+                    # before a restart) the capture is read from disk
+                    if not tracker.has_files():
+                        GlobalTracker.release_files(folder)
+                GlobalTracker.save(folder)
+
+            # Both wait for room when their queue is full, without holding the
+            # lock, so other consumers keep registering files
+            if write:
+                persist(folder, self._output_dir / rel_filepath, contents)
+            if not queue:
+                return None
+            analysis_queue.put((folder, folderpath, output_filepath))
+            self.logger.info(f"Queued {folder} for analysis, {analysis_queue.qsize()} "
+                             f"capture(s) waiting")
 
         except Exception as exc:
             return exc
@@ -131,6 +435,119 @@ class ImageAnalysisProcessor(DataFileStreamProcessor):
     def run_from_command_line(cls, args=None):
         pass
 
+def analysis_task(stream_processor):
+    """Takes captures from analysis_queue and analyzes them, saving and 
+    uploading every fit parameter, not just the temperature, as a result 
+    payload. ANALYSIS_WORKERS threads run this at once, sharing the history
+    of previous captures through the reentrant default_analyzer. A failed 
+    analysis is logged and queued again after a growing delay, up to 
+    ANALYSIS_RETRIES times, and then saved as failed for the next restart
+
+    Args:
+        stream_processor (ImageAnalysisProcessor): processor queueing the 
+            captures, for its output directory and logger
+    """
+    while True:
+        folder, folderpath, output_filepath = analysis_queue.get()
+        analyzed = False
+        with GlobalTracker.lock:
+            # Unless they were released over TRACKER_FILES_BUDGET while queued
+            tracker = GlobalTracker.get(folder)
+            tracker.mark_analyzing()
+            files = tracker.files if tracker.has_files() else None
+        try:
+            stream_processor.logger.info(f"Analyzing {folder}"
+                                         f"{' in memory' if files is not None else ''}, "
+                                         f"{analysis_queue.qsize()} capture(s) waiting")
+            if files is None and PROCESSOR_MODE == "memory":
+                if not PERSIST_CAPTURES:
+                    raise RuntimeError("its files are not all in memory and "
+                                       "PERSIST_CAPTURES is off, so none are on disk")
+                # Read from disk once the files received so far are written
+                with persisted:
+                    persisted.wait_for(lambda: folder not in pending_writes)
+            fit = temperature_analysis.default_analyzer.analyze(folderpath, files=files, 
+                                                                quiet=False)
+            if type(fit) == str:
+                raise RuntimeError(f"the analysis returned {fit}")
+            # In memory mode the folder may not have been written (yet)
+            pathlib.Path(output_filepath).parent.mkdir(parents=True, exist_ok=True)
+            # Sent as a compact result payload (see result_payload.py)
+            result_payload.save(output_filepath, temperature_analysis.result_arrays(fit))
+            if ARCHIVE_DIR is not None:
+                temperature_analysis.archive_capture(
+                    archive.Archive(ARCHIVE_DIR), folderpath, fit, files=files)
+            upload_file = UploadDataFile(output_filepath, rootdir=stream_processor._output_dir)
+            upload_file.upload_whole_file(CONFIG_FILE_PATH, TOPIC_NAME)
+            analyzed = True
+        except Exception as exc:
+            stream_processor.logger.error(f"Analysis of {folder} failed: {exc}")
+        finally:
+            with GlobalTracker.lock:
+                # Retries read the capture from disk, so either way its 
+                # memory is released here
+                tracker = GlobalTracker.get(folder)
+                tracker.mark_analyzing(False)
+                if analyzed:
+                    tracker.mark_analyzed()
+                else:
+                    tracker.mark_failed()
+                    tracker.mark_queued(resumable and tracker.failures <= ANALYSIS_RETRIES)
+                GlobalTracker.release_files(folder)
+                GlobalTracker.save(folder, output_filepath if analyzed else None)
+                failures, retry = tracker.failures, tracker.is_queued() and not analyzed
+            if retry:
+                delay = ANALYSIS_RETRY_DELAY * 2**(failures - 1)
+                stream_processor.logger.warning(f"Retrying {folder} in {delay} s "
+                                                f"({failures} of {ANALYSIS_RETRIES})")
+                timer = Timer(delay, analysis_queue.put, 
+                              args=((folder, folderpath, output_filepath),))
+                timer.daemon = True
+                timer.start()
+            elif not analyzed:
+                stream_processor.logger.error(f"Giving up on {folder} after {failures} "
+                                              f"failed analyses")
+            analysis_queue.task_done()
+
+def reserve_write(folder):
+    "Counts a file of the folder as pending until persist_task has written it"
+    with persisted:
+        pending_writes[folder] = pending_writes.get(folder, 0) + 1
+
+def persist(folder, filepath, contents):
+    """Queues a file received in memory, counted by reserve_write, to be 
+    written to disk by persist_task, waiting while persist_queue is full"""
+    persist_queue.put((folder, filepath, contents))
+
+def persist_task(stream_processor):
+    """Writes the files received in memory mode to disk, one after another,
+    so the analysis never waits on it. Each file is written under a 
+    temporary name and renamed, so a half-written file is never mistaken 
+    for a received one
+
+    Args:
+        stream_processor (ImageAnalysisProcessor): processor receiving the 
+            files, for its logger
+    """
+    while True:
+        folder, filepath, contents = persist_queue.get()
+        try:
+            filepath = pathlib.Path(filepath)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            temporary = filepath.with_name(filepath.name + ".tmp")
+            with open(temporary, "wb") as file:
+                file.write(contents)
+            os.replace(temporary, filepath)
+        except Exception as exc:
+            stream_processor.logger.error(f"Writing {filepath} failed: {exc}")
+        finally:
+            with persisted:
+                pending_writes[folder] -= 1
+                if pending_writes[folder] == 0:
+                    del pending_writes[folder]
+                    persisted.notify_all()
+            persist_queue.task_done()
+
 def stream_processor_task(stream_processor):
     """Run "process_files_as_read" for the given stream processor, and log a message
     when it gets shuts down
@@ -170,20 +587,53 @@ iap = ImageAnalysisProcessor(
     config_file=CONFIG_FILE_PATH,
     topic_name=CONSUMER_TOPIC_NAME,
     output_dir=STREAM_PROCESSOR_OUTPUT_DIR,
-    mode="disk"
+    mode=PROCESSOR_MODE
 )
 # Start running its "process_files_as_read" function in a separate thread
 processor_thread = Thread(
     target=stream_processor_task,
     args=(iap,),
 )
+# Queue of (folder, folder path, result path) of the captures to analyze, 
+# served by the analysis threads, which take the files held in memory from
+# the capture's tracker
+analysis_queue = Queue(maxsize=ANALYSIS_QUEUE_SIZE)
+analysis_threads = [
+    Thread(target=analysis_task, args=(iap,), daemon=True)
+    for _ in range(ANALYSIS_WORKERS)
+]
+# Queue of (folder, path, contents) of the files received in memory to write
+# to disk, and the number of them per folder not yet written, guarded by 
+# persisted, which is notified as a folder's last one is
+persist_queue = Queue(maxsize=PERSIST_QUEUE_SIZE)
+pending_writes = dict()
+persisted = Condition()
+persist_thread = Thread(target=persist_task, args=(iap,), daemon=True)
+# Whether captures are on disk to be retried or resumed from
+resumable = PROCESSOR_MODE != "memory" or PERSIST_CAPTURES
 
 if __name__ == "__main__": 
+    if PROCESSOR_MODE == "memory" and PERSIST_CAPTURES:
+        persist_thread.start()
     processor_thread.start()
-
-    # Periodically remove analyzed images from the tracker
+    for analysis_thread in analysis_threads:
+        analysis_thread.start()
+
+    # Finish the analyses interrupted or failed when the processor last 
+    # stopped, from the files written to disk
+    if not resumable:
+        iap.logger.warning("PERSIST_CAPTURES is off, so analyses interrupted when the "
+                           "processor last stopped cannot be resumed")
+    for folder in GlobalTracker.resume() if resumable else ():
+        analysis_queue.put((folder, str(STREAM_PROCESSOR_OUTPUT_DIR / folder), 
+                            STREAM_PROCESSOR_OUTPUT_DIR / folder / f"result{result_payload.suffix}"))
+        iap.logger.info(f"Resuming analysis of {folder}, {analysis_queue.qsize()} "
+                        f"capture(s) waiting")
+
+    # Periodically forget analyzed and abandoned captures
     while True:
-        sleep(86400)
-        for key in GlobalTracker.keys():
-            if GlobalTracker[key].is_analyzed():
-                del GlobalTracker[key]
+        sleep(TRACKER_SWEEP_INTERVAL)
+        expired = GlobalTracker.expire()
+        if expired > 0:
+            iap.logger.info(f"Forgot {expired} finished or abandoned folder(s), "
+                            f"tracking {len(GlobalTracker)}")
@@ -2,9 +2,22 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import least_squares
-import spectral.io.envi as envi
 from tqdm.contrib import itertools
-from time import sleep
+from itertools import product
+from time import sleep, perf_counter
+import os
+import math
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import shared_memory
+import envi_header
+try:
+    import numba
+except ImportError:
+    numba = None
 
 ### Constants ###
 h = 6.626e-34 # Planck's constant
@@ -12,13 +25,45 @@ c = 299792458 # Speed of light
 k = 1.380649e-23 # Boltzmann constant
 b = 2.89777e-3 # Wien's constant
 
+### Fitting Settings ###
+cold_params0 = np.array([1, 1, 1, 0.1, 1000]) # [a0, a1, a2, offset, T] cold start, scaled to each spectrum by cold_start
+max_plausible_T = 1e4 # fits hotter than this count as diverged
+min_plausible_T = 500 # fits colder than this collapsed onto the stray light offset
+                      # and count as diverged, as does any T hot_mask would reject
+seed_codes = {"neighbor": 1, "previous": 2, "coarse": 3, "wien": 4, "lut": 5, 
+              "parent": 6} # -1 marks a fallback
+lut_dir = "spectral_lut" # directory of the table written by build_lut
+reference_cache_dir = "reference_cache" # directory of the references read_references saved
+reference_cache_size = 8 # references kept in memory
+reference_cache_files = 32 # references kept in reference_cache_dir, least recently used dropped first
+background = -2 # status and temperature of pixels hot_mask skips (failed fits get -1)
+kernel_backend = "numpy" # or "numba" for compiled Planck kernels, see set_kernel_backend
+lazy_frames = 64 # frames corrected at a time when fitting a LazyCapture
+saturation = None # raw count at which a band saturates, None for the data type's maximum
+
+### Band Settings ###
+# Wavelengths 950 to 1000 nm are excluded since stray laser light amplifies 
+# intensities at those wavelengths
+band_range = (0, 950) # nm, fitted bands lie in [start, end)
+band_bin = 1 # adjacent bands averaged into each fitted band
+band_exclude = [] # (start, end) nm windows to drop, e.g. laser or emission lines
+
 ### Other Global Variables ###
 image = None
 units = None
 wavelengths = None
+grid = None # WavelengthGrid of the fitted wavelengths
+grid_cache = dict() # header wavelength block hash -> WavelengthGrid
 spectrum = None
+dark_noise = None # per band noise of one corrected pixel, from the dark reference
+band_selection = None # header bands making up each fitted band, see select_bands
 temp_arr = None
+fit_result = None # fit maps of the latest analysis, see save_result
 folder = None
+previous_fits = dict() # capture series folder -> converged params of its latest capture
+cold_nfev_reference = [0, 0] # total evaluations and count of cold fits so far
+reference_cache = dict() # reference files hash -> references, see read_references
+reference_lock = threading.Lock()
 
 ### Helper Functions ###
 
@@ -45,67 +90,548 @@ def construct_paths(folder_path):
     retval.append(folder_path + "/frameIndex.txt")
     return retval
 
-def load_data(paths, quiet=False):
-    """Input: paths list generated by (or in format of) construct_paths
+def load_data(paths, quiet=False, bins=None, chunk_frames=500):
+    """Input: paths list generated by (or in format of) construct_paths,
+            bins: (frames, positions, bands) factors to average the corrected 
+            image over while loading (see bin_cube), None to keep full 
+            resolution, chunk_frames: frames read and corrected at a time when
+            binning, so the full resolution image is never held in memory
     Output: hyperspectral tensor corrected by the white and dark references"""
+    global dark_noise
+
     print("Loading data...")
     try:
-        data_ref = envi.open(paths[0], paths[1])
-        white_ref = envi.open(paths[2], paths[3])
-        dark_ref = envi.open(paths[4], paths[5])
-
-        white_tensor = np.array(white_ref.load())
-        dark_tensor = np.array(dark_ref.load())
-        data_tensor = np.array(data_ref.load())
+        corrected_data, dark_noise = read_capture(paths, bins, chunk_frames)
     except:
         print("Load failed, waiting 30 seconds...")
         sleep(30)
         return "FAIL"
 
-    corrected_data = np.divide(
-        np.subtract(data_tensor, dark_tensor),
-        np.subtract(white_tensor, dark_tensor))
-
     if not quiet:
         print(corrected_data)
     return corrected_data
 
+def read_capture(paths, bins=None, chunk_frames=500, out=None, lazy=False, files=None):
+    """Loads and corrects an image without touching any global variables
+    Input: paths, bins, chunk_frames: as in load_data, out: preallocated 
+            binned output for load_binned, lazy: at full resolution, return 
+            the memory-mapped LazyCapture instead of reading the whole image,
+            files: contents of the capture's files already in memory (see 
+            open_image), None to read them from paths
+    Output: corrected image, per band noise of one corrected pixel estimated
+            from the spread of the dark reference (see dark_noise)"""
+    capture = LazyCapture(paths, files=files)
+    if bins is not None:
+        corrected_data = load_binned(capture, bins, chunk_frames, out=out)
+    elif lazy:
+        corrected_data = capture
+    else:
+        corrected_data = np.asarray(capture)
+    return corrected_data, capture.reference_noise()
+
+class LazyCapture():
+    """Corrected image of a capture whose raw cube stays memory-mapped on disk.
+    Frames are only read, corrected by the white and dark references and 
+    reduced to the fitted bands when indexed, a block at a time, so the full 
+    resolution image never has to be held in memory. Indexing with a frame 
+    or a slice of frames gives a float32 array; np.asarray gives the whole
+    image. Pickles as its paths, so pool workers reopen the map themselves,
+    or with its files when it was decoded from memory (fit_image_parallel 
+    shares those through shared memory instead, see _share_files)"""
+
+    def __init__(self, paths, selection=None, files=None):
+        """Input: paths list generated by (or in format of) construct_paths,
+                selection: header bands to reduce to (see select_bands), None
+                to keep every band, files: contents of the capture's files 
+                (see open_image), None to map them from paths"""
+        self.paths = paths
+        self.files = files
+        self.raw = open_image(paths[0], paths[1], files)
+        self.references = read_references(paths, files)
+        self.with_bands(selection, copy=False)
+
+    def with_bands(self, selection, copy=True):
+        """Input: selection of the header bands (see select_bands), copy: 
+                return a new capture sharing this one's map instead of 
+                changing this one
+        Output: the capture reduced to the selected bands"""
+        capture = LazyCapture.__new__(LazyCapture) if copy else self
+        if copy:
+            capture.__dict__.update(self.__dict__)
+        capture.selection = selection
+        n_bands = self.raw.shape[2] if selection is None else len(selection["starts"])
+        capture.shape = self.raw.shape[:2] + (n_bands,)
+        return capture
+
+    dtype = np.dtype(np.float32)
+    ndim = 3
+
+    @property
+    def nbytes(self):
+        return math.prod(self.shape) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def frames(self, start, end, out=None):
+        """Input: first and last + 1 frame, out: float32 array to write the 
+                frames into, None to allocate one
+        Output: corrected float32 frames [start, end), NaN where the pixel 
+                is not valid (see correct_frames)"""
+        if self.selection is None:
+            corrected, _ = correct_frames(self.raw[start:end], self.references, start, 
+                                          self.raw.shape[0], out=out)
+            return corrected
+        corrected, _ = correct_frames(self.raw[start:end], self.references, start, 
+                                      self.raw.shape[0], valid_bands=self.selection["index"])
+        corrected = apply_bands(corrected, self.selection)
+        if out is None:
+            return corrected
+        out[:] = corrected
+        return out
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.shape[0])
+            block = self.frames(start, max(end, start))[::step]
+        else:
+            index = range(self.shape[0])[key]
+            block = self.frames(index, index + 1)[0]
+        return block[rest] if rest else block
+
+    def blocks(self, step=None):
+        """Input: step: frames per block, None for lazy_frames
+        Output: generator of (start, end, corrected frames [start, end))"""
+        step = lazy_frames if step is None else step
+        for start in range(0, self.shape[0], step):
+            end = min(start + step, self.shape[0])
+            yield start, end, self.frames(start, end)
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(self.shape, dtype=np.float32)
+        for start in range(0, self.shape[0], lazy_frames):
+            end = min(start + lazy_frames, self.shape[0])
+            self.frames(start, end, out=out[start:end])
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def reference_noise(self):
+        """Output: per header band noise of one corrected pixel (see 
+                read_references)"""
+        return self.references["noise"]
+
+    def __getstate__(self):
+        return {"paths": self.paths, "selection": self.selection, "files": self.files}
+
+    def __setstate__(self, state):
+        self.__init__(state["paths"], state["selection"], state["files"])
+
+def open_image(header_path, data_path, files=None):
+    """Input: paths of an ENVI header and its data, files: dict of file name
+            (e.g. "raw.hdr") -> contents of the capture's files received in
+            memory, None to read them from disk
+    Output: read only (lines, samples, bands) view of the image, mapped from
+            disk or decoded in place from files"""
+    if files is None:
+        return envi_header.memmap_image(header_path, data_path)
+    return envi_header.image_from_bytes(files[os.path.basename(header_path)],
+                                        files[os.path.basename(data_path)])
+
+def capture_header(paths, files=None):
+    """Input: paths list generated by (or in format of) construct_paths, 
+            files: as in open_image
+    Output: EnviHeader of the capture's raw image"""
+    if files is None:
+        return envi_header.read_header(paths[0])
+    return envi_header.header_from_bytes(files[os.path.basename(paths[0])])
+
+def reference_key(paths, files=None):
+    """Input: paths list generated by (or in format of) construct_paths, 
+            files: as in open_image
+    Output: hash of the contents of the white and dark reference files"""
+    digest = hashlib.sha1()
+    for path in paths[2:6]:
+        if files is not None:
+            digest.update(files[os.path.basename(path)])
+            continue
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def read_references(paths, files=None):
+    """Reads the white and dark references of a capture, or reuses them when
+    an earlier capture had identical ones, from memory or from 
+    reference_cache_dir
+    Input: paths list generated by (or in format of) construct_paths, 
+            files: as in open_image
+    Output: dict of the float32 dark reference ("dark"), the gain 
+            1 / (white - dark) ("gain"), zero where white is not above dark,
+            where the gain is not zero ("usable", see correct_frames), the 
+            per band noise of one corrected pixel estimated from the spread 
+            of the dark reference ("noise", see dark_noise) and the key of 
+            the references ("key")"""
+    key = reference_key(paths, files)
+    with reference_lock:
+        if key in reference_cache:
+            reference_cache[key] = reference_cache.pop(key) # most recently used last
+            return reference_cache[key]
+
+    cache_path = os.path.join(reference_cache_dir, key + ".npz")
+    try:
+        with np.load(cache_path, allow_pickle=False) as cached:
+            references = {name: cached[name] for name in ("dark", "gain", "noise")}
+        os.utime(cache_path) # most recently used, see prune_reference_cache
+    except (OSError, KeyError, ValueError):
+        white = np.asarray(open_image(paths[2], paths[3], files), dtype=np.float32)
+        dark = np.asarray(open_image(paths[4], paths[5], files), dtype=np.float32)
+        span = white - dark
+        gain = np.zeros_like(span)
+        np.divide(1, span, out=gain, where=span > 0)
+
+        bands = dark.shape[-1]
+        typical_span = np.median(np.abs(span).reshape(-1, bands), axis=0)
+        noise = np.std(dark.reshape(-1, bands), axis=0) / np.maximum(typical_span, 1e-12)
+        references = {"dark": dark, "gain": gain, "noise": noise}
+        try:
+            os.makedirs(reference_cache_dir, exist_ok=True)
+            # Written under a temporary name so other processes never load a 
+            # partial file
+            temporary = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.npz"
+            np.savez(temporary, **references)
+            os.replace(temporary, cache_path)
+            prune_reference_cache()
+        except OSError as exc:
+            print(f"Could not cache references in {reference_cache_dir} ({exc})")
+    references["usable"] = references["gain"] > 0
+    references["key"] = key
+
+    with reference_lock:
+        reference_cache[key] = references
+        while len(reference_cache) > reference_cache_size:
+            reference_cache.pop(next(iter(reference_cache)))
+    return references
+
+def prune_reference_cache(keep=None):
+    """Deletes the least recently used references in reference_cache_dir, 
+    by modification time, which read_references renews on every load
+    Input: keep: references to keep, None for reference_cache_files
+    Output: number of files deleted"""
+    keep = reference_cache_files if keep is None else keep
+    entries = []
+    for entry in os.scandir(reference_cache_dir):
+        # Temporary files of writes in progress end in .npz too, but hold a
+        # process id before it
+        if entry.name.endswith(".npz") and entry.name.count(".") == 1:
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+    entries.sort()
+    deleted = 0
+    for _, path in entries[:max(len(entries) - keep, 0)]:
+        try:
+            os.remove(path)
+            deleted += 1
+        except OSError:
+            continue
+    return deleted
+
+def correct_frames(raw, references, start=0, n_frames=None, out=None, valid_bands=None):
+    """Applies the white and dark reference correction (raw - dark) * gain in
+    float32 without temporaries, and blanks the pixels that cannot be 
+    measured: those with a saturated band (see saturation) or a band where 
+    white is not above dark. Their spectra are set to NaN, which binning 
+    leaves out of its averages (see bin_cube) and the fitters skip (see 
+    valid_pixels)
+    Input: raw (frames, positions, bands) frames, references from 
+            read_references, start: number of the first frame, n_frames: 
+            frames in the whole capture, None if still unknown, out: float32
+            array of raw's shape to write into, None to allocate one, 
+            valid_bands: header bands that have to be valid, None for every
+            band
+    Output: (corrected float32 frames, (frames, positions) boolean mask of 
+            the valid pixels)"""
+    dark, gain, usable = references["dark"], references["gain"], references["usable"]
+    # References with one row per frame are read alongside the image, 
+    # others broadcast over every frame
+    if dark.shape[0] > 1 and dark.shape[0] == n_frames:
+        rows = slice(start, start + len(raw))
+        dark, gain, usable = dark[rows], gain[rows], usable[rows]
+    if out is None:
+        out = np.empty(raw.shape, dtype=np.float32)
+    np.subtract(raw, dark, out=out)
+    np.multiply(out, gain, out=out)
+
+    if valid_bands is not None:
+        raw, usable = raw[..., valid_bands], usable[..., valid_bands]
+    valid = np.broadcast_to(np.all(usable, axis=-1), raw.shape[:2]).copy()
+    limit = saturation
+    if limit is None and np.issubdtype(raw.dtype, np.integer):
+        limit = np.iinfo(raw.dtype).max
+    if limit is not None:
+        valid &= ~np.any(raw >= limit, axis=-1)
+    out[~valid] = np.nan
+    return out, valid
+
+def valid_pixels(cube):
+    """Input: corrected cube
+    Output: (frames, positions) boolean mask of the pixels with a finite 
+            spectrum, those correct_frames did not blank"""
+    return np.isfinite(np.sum(cube, axis=2))
+
+def frame_blocks(cube, step=None):
+    """Input: corrected image, in memory or a LazyCapture, step: frames per 
+            block, None for lazy_frames
+    Output: generator of (start, end, frames [start, end) of the image)"""
+    if isinstance(cube, LazyCapture):
+        yield from cube.blocks(step)
+        return
+    step = lazy_frames if step is None else step
+    for start in range(0, cube.shape[0], step):
+        end = min(start + step, cube.shape[0])
+        yield start, end, cube[start:end]
+
+def indexed_frames(index_path):
+    """Input: path of a capture's frameIndex.txt
+    Output: number of frames it lists, None if it does not exist yet"""
+    try:
+        with open(index_path, "r") as file:
+            lines = file.readlines()
+    except FileNotFoundError:
+        return None
+    # Only whole lines starting with a frame number count, not the column 
+    # names or a line still being written
+    return sum(1 for line in lines 
+               if line.endswith("\n") and line.split()[:1] and line.split()[0].isdigit())
+
+def wait_for(path, poll=0.5, timeout=30):
+    """Waits for a file to appear
+    Output: True if it did within timeout seconds"""
+    waited = 0
+    while not os.path.exists(path):
+        if waited >= timeout:
+            return False
+        sleep(poll)
+        waited += poll
+    return True
+
+def stream_frames(paths, poll=0.5, timeout=30, valid_bands=None):
+    """Reads and corrects the frames of a capture while the camera is still 
+    writing it, one frame (a line of positions) at a time. A frame is read 
+    once it is whole in the raw file and, if frameIndex.txt exists, listed 
+    there. The capture ends after the header's number of lines, or when no
+    new frame arrived for timeout seconds, after which whatever whole frames
+    the raw file holds are read regardless of the index
+    Input: paths list generated by (or in format of) construct_paths, poll:
+            seconds between checks for new frames, timeout: seconds to wait
+            for the files or for a new frame, valid_bands: header bands that
+            have to be valid (see correct_frames), None for every band
+    Output: generator of (frame number, corrected float32 (positions, header 
+            bands) frame)"""
+    if not (wait_for(paths[0], poll, timeout) and wait_for(paths[1], poll, timeout)):
+        return
+    header = envi_header.read_header(paths[0])
+    samples, bands, interleave = header.samples, header.bands, header.interleave
+    if interleave not in ("bil", "bip"):
+        raise ValueError(f"Cannot stream a {interleave} capture, its frames are not "
+                         "stored one after another")
+    dtype, offset, frame_bytes = header.dtype, header.header_offset, header.frame_bytes
+    expected = header.lines or None
+    references = read_references(paths)
+
+    n_read, idle, finished = 0, 0, False
+    with open(paths[1], "rb") as file:
+        while not finished and (expected is None or n_read < expected):
+            available = (os.fstat(file.fileno()).st_size - offset) // frame_bytes
+            listed = indexed_frames(paths[6])
+            new = available - n_read if listed is None else min(available, listed) - n_read
+            if expected is not None:
+                new = min(new, expected - n_read)
+            if new <= 0:
+                if idle < timeout:
+                    sleep(poll)
+                    idle += poll
+                    continue
+                # Nothing new for a while: read what the file holds and stop
+                new, finished = available - n_read, True
+                if new <= 0:
+                    break
+            idle = 0
+
+            file.seek(offset + n_read * frame_bytes)
+            raw = np.frombuffer(file.read(new * frame_bytes), dtype=dtype)
+            if interleave == "bil":
+                raw = raw.reshape(new, bands, samples).transpose(0, 2, 1)
+            else:
+                raw = raw.reshape(new, samples, bands)
+            corrected, _ = correct_frames(raw, references, n_read, expected, 
+                                          valid_bands=valid_bands)
+            for i in range(new):
+                yield n_read + i, corrected[i]
+            n_read += new
+
+def frame_batches(*streams, step=None):
+    """Input: iterables of (frame number, frame) such as stream_frames, read 
+            one after another, step: frames per batch, None for lazy_frames
+    Output: generator of (frames, positions, bands) arrays of step frames, 
+            the last one holding whatever remains"""
+    step = lazy_frames if step is None else step
+    pending = []
+    for stream in streams:
+        for _, frame in stream:
+            pending.append(frame)
+            if len(pending) == step:
+                yield np.stack(pending)
+                pending = []
+    if pending:
+        yield np.stack(pending)
+
+def binned_shape(shape, bins):
+    """Output: shape of a cube of the given shape after bin_cube"""
+    return tuple(-(-n // f) for n, f in zip(shape, bins))
+
+def load_binned(capture, bins, chunk_frames=500, out=None):
+    """Corrects and bins an image a chunk of frames at a time
+    Input: capture: LazyCapture of the image, bins: (frames, positions, 
+            bands) factors (see bin_cube), chunk_frames: frames per chunk, 
+            rounded down to a multiple of bins[0], out: float32 array of the
+            binned shape to write into, None to allocate one
+    Output: corrected, binned float32 image"""
+    step = max(chunk_frames // bins[0], 1) * bins[0]
+    if out is None:
+        out = np.empty(binned_shape(capture.shape, bins), dtype=np.float32)
+
+    for start, end, corrected in capture.blocks(step):
+        bin_cube(corrected, bins, out=out[start // bins[0]:-(-end // bins[0])])
+    return out
+
 def get_bands(paths, quiet=False):
     """Input: paths list generated by (or in format of) construct_paths
     Output: (Array of wavelength bands, wavelength units string)"""
     print("Getting wavelength bands...")
     global wavelengths
     global units
-    file = open(paths[0], 'r')
-    text = file.read()
-
-    start_id = "\nwavelength = {\n"
-    start_index = text.find(start_id) + len(start_id)
-    end_id = "\n}\n;AOI height"
-    end_index = text.find(end_id)
-    wavelengths = text[start_index:end_index]
-    wavelengths = np.array(wavelengths.split("\n,"), dtype=np.float32)
-
-    units_id = "wavelength units = "
-    units_index = text.find(units_id) + len(units_id)
-    units = text[units_index:text.find(start_id)]
+    global band_selection
+    wavelengths, units, block = read_header_bands(paths[0])
 
     if not quiet:
         print(f"Units = {units}")
         print(f"Number wavelengths = {len(wavelengths)}")
         print(f"Wavelengths: {wavelengths}")
-        print(f"Removing wavelengths over 950 nm...")
 
-    # [:339] removes wavelengths 950 to 1000 nm since stray laser light 
-    # amplifies intensities at those wavelengths, so we wish to ignore them in 
-    # the fitting
-    wavelengths = wavelengths[:339]
+    band_selection = select_bands(wavelengths)
+    if not quiet:
+        print(f"Fitting {len(band_selection['wavelengths'])} bands from {band_range} nm, "
+              f"binned by {band_bin}, excluding {band_exclude}...")
+    set_grid(band_selection["wavelengths"], key=grid_key(block, band_selection))
 
     return None
 
-def compress_horiz_slice(data, start_idx, end_idx):
-    return np.array([np.divide(np.sum(data[:,start_idx:end_idx,:],axis=1), 
-                     end_idx-start_idx)])
+def read_header_bands(header_path, header=None):
+    """Input: path of a capture's raw.hdr, header: its EnviHeader if already
+            read (see capture_header)
+    Output: (array of every band's wavelength, wavelength units string, key 
+            of the wavelengths for grid_key)"""
+    if header is None:
+        header = envi_header.read_header(header_path)
+    if header.wavelength is None:
+        raise ValueError(f"{header_path} lists no wavelengths")
+    return header.wavelength, header.wavelength_units, header.wavelength_key
+
+def grid_key(block, selection):
+    """Input: wavelength key from read_header_bands, band selection
+    Output: key identifying the fitted grid, for set_grid and cached_grid"""
+    return block.encode() + selection["index"].tobytes() + selection["starts"].tobytes()
+
+### Band Selection ###
+def select_bands(header_wavelengths, wl_range=None, bin_factor=None, exclude=None):
+    """Chooses the bands to fit by wavelength rather than by position, and how
+    adjacent ones are averaged together. Bins never straddle an excluded 
+    window, and the last bin of a run of bands may be partial
+    Input: wavelengths of every band in the header (nm), wl_range, bin_factor,
+            exclude: as band_range, band_bin and band_exclude (the defaults)
+    Output: dict of index (header bands kept), starts (position in index at 
+            which each fitted band begins), counts (header bands in each) and 
+            wavelengths (mean wavelength of each fitted band)"""
+    wl_range = band_range if wl_range is None else wl_range
+    bin_factor = band_bin if bin_factor is None else bin_factor
+    exclude = band_exclude if exclude is None else exclude
+    header_wavelengths = np.asarray(header_wavelengths, dtype=np.float64)
+
+    keep = (header_wavelengths >= wl_range[0]) & (header_wavelengths < wl_range[1])
+    for start, end in exclude:
+        keep &= ~((header_wavelengths >= start) & (header_wavelengths <= end))
+    index = np.flatnonzero(keep)
+
+    # Runs of adjacent kept bands, each binned separately
+    run_starts = np.flatnonzero(np.diff(index, prepend=-2) != 1)
+    run_ends = np.append(run_starts[1:], len(index))
+    starts = np.concatenate([np.arange(start, end, bin_factor) 
+                             for start, end in zip(run_starts, run_ends)] + [[]]).astype(np.int64)
+    counts = np.diff(np.append(starts, len(index)))
+    return {
+        "index": index,
+        "starts": starts,
+        "counts": counts,
+        "wavelengths": (np.add.reduceat(header_wavelengths[index], starts) / counts).astype(np.float32),
+    }
+
+def apply_bands(cube, selection=None):
+    """Reduces the last axis of a cube from the header bands to the fitted bands
+    Input: (..., header bands) array, selection: from select_bands, defaults 
+            to that of the latest get_bands
+    Output: (..., fitted bands) array, a view when the fitted bands are a 
+            contiguous unbinned range of the header's; for a LazyCapture, a 
+            LazyCapture reducing each block as it is read"""
+    selection = band_selection if selection is None else selection
+    if isinstance(cube, LazyCapture):
+        return cube.with_bands(selection)
+    index, starts, counts = selection["index"], selection["starts"], selection["counts"]
+    if len(index) > 0 and index[-1] - index[0] + 1 == len(index) and np.all(counts == 1):
+        return cube[..., index[0]:index[-1] + 1]
+    return (np.add.reduceat(cube[..., index], starts, axis=-1) / counts).astype(np.float32)
+
+def bin_cube(cube, bins, out=None):
+    """Averages a cube over blocks of bins[0] frames x bins[1] positions x 
+    bins[2] bands in one pass, each whole block through a reshaped view of the
+    cube and the last, partial block along each axis over whatever remains.
+    NaN (blanked) values are left out of the averages, so a block is only NaN
+    when none of its values are valid
+    Input: (frames, positions, bands) cube, bins: factor per axis,
+            out: preallocated output of the binned shape, None to allocate 
+            float32
+    Output: the binned cube"""
+    if out is None:
+        out = np.empty(binned_shape(cube.shape, bins), dtype=np.float32)
+
+    # Per axis, (start, stop, blocks, block size) of the whole blocks and of
+    # the ragged edge
+    segments = []
+    for n, f in zip(cube.shape, bins):
+        whole = n // f
+        axis = [(0, whole * f, whole, f)] if whole > 0 else []
+        if n % f:
+            axis.append((whole * f, n, 1, n % f))
+        segments.append(axis)
+
+    for s0, s1, s2 in product(*segments):
+        block = cube[s0[0]:s0[1], s1[0]:s1[1], s2[0]:s2[1]]
+        block = block.reshape(s0[2], s0[3], s1[2], s1[3], s2[2], s2[3])
+        o0, o1, o2 = s0[0] // bins[0], s1[0] // bins[1], s2[0] // bins[2]
+        target = out[o0:o0 + s0[2], o1:o1 + s1[2], o2:o2 + s2[2]]
+        # Blocks holding pixels blanked by correct_frames average only their
+        # valid ones; a finite total rules those out without a mask
+        if np.isfinite(np.sum(block)):
+            np.mean(block, axis=(1, 3, 5), out=target)
+            continue
+        finite = np.isfinite(block)
+        np.sum(np.where(finite, block, 0), axis=(1, 3, 5), out=target)
+        with np.errstate(divide="ignore", invalid="ignore"): # blocks of no valid pixels stay NaN
+            np.divide(target, np.sum(finite, axis=(1, 3, 5)), out=target)
+    return out
 
 def shrink_image(chunk_size=10, quiet=False):
     """Blurs an image to reduce it's size
@@ -113,25 +639,291 @@ def shrink_image(chunk_size=10, quiet=False):
     Output: the blurred image"""
     global image
 
-    for itera in range(2):
-        horiz_slices = []
-        for i in range(image.shape[1] // chunk_size):
-            start_idx = i * chunk_size
-            end_idx = (i + 1) * chunk_size
-            if end_idx < image.shape[1]:
-                horiz_slices.append(compress_horiz_slice(image, start_idx, end_idx))
-            elif start_idx == image.shape[1]:
-                continue
-            else:
-                horiz_slices.append(compress_horiz_slice(image, start_idx, image.shape[1]))
+    image = bin_cube(image, (chunk_size, chunk_size, 1))
+    return image
 
-        image = np.concatenate(tuple(horiz_slices), axis=0)
+### Wavelength Grid ###
 
-    return image
+class WavelengthGrid():
+    """Per-band constants of the Planck model for a fixed wavelength grid, 
+    computed once instead of on every model evaluation"""
+    def __init__(self, wavelengths_nm):
+        self.nm = np.asarray(wavelengths_nm)
+        self.l = self.nm.astype(np.float64) * 1e-9 # assuming units are nm
+        self.radiance = (2 * h * c**2) / self.l**5 # e * radiance / (exp(x) - 1)
+        self.log_radiance = np.log(self.radiance)
+        self.exponent = (h * c) / (self.l * k) # x = exponent / T
+        self.center = np.mean(self.l)
+        self.half_span = np.ptp(self.l) / 2 or 1.0
+        # The emissivity polynomial is evaluated in u, running from -1 to 1 
+        # across the band, rather than in metres, where a1 and a2 move the 
+        # model 1e7 and 1e13 times less than a0: e = [b0, b1, b2] @ vandermonde.T
+        # for the coefficients of scaled_params
+        self.u = (self.l - self.center) / self.half_span
+        self.vandermonde = np.stack((np.ones_like(self.u), self.u, self.u**2), axis=-1)
+
+    def __len__(self):
+        return len(self.l)
+
+    def scaled_params(self, params):
+        """Input: (..., 5) params [a0, a1, a2, offset, T], the emissivity a 
+                polynomial in wavelength (m)
+        Output: the same params with the emissivity as a polynomial in u, 
+                [b0, b1, b2, offset, T]"""
+        params = np.array(params, dtype=np.float64)
+        a0, a1, a2 = params[..., 0].copy(), params[..., 1].copy(), params[..., 2].copy()
+        l0, s = self.center, self.half_span
+        params[..., 0] = a0 + a1 * l0 + a2 * l0**2
+        params[..., 1] = s * (a1 + 2 * a2 * l0)
+        params[..., 2] = s**2 * a2
+        return params
+
+    def unscaled_params(self, params):
+        """Inverse of scaled_params
+        Input: (..., 5) params [b0, b1, b2, offset, T]
+        Output: (..., 5) params [a0, a1, a2, offset, T]"""
+        params = np.array(params, dtype=np.float64)
+        b0, b1, b2 = params[..., 0].copy(), params[..., 1].copy(), params[..., 2].copy()
+        l0, s = self.center, self.half_span
+        params[..., 2] = b2 / s**2
+        params[..., 1] = b1 / s - 2 * params[..., 2] * l0
+        params[..., 0] = b0 - params[..., 1] * l0 - params[..., 2] * l0**2
+        return params
+
+def set_grid(new_wavelengths, key=None):
+    """Makes the given wavelengths (in nm) the fitted grid, reusing the cached 
+    WavelengthGrid when a capture with the same header wavelengths was seen
+    Input: wavelengths, key: header text defining them (defaults to the values)
+    Output: the WavelengthGrid"""
+    global wavelengths
+    global grid
+    grid = cached_grid(new_wavelengths, key)
+    wavelengths = grid.nm
+    return grid
+
+def cached_grid(new_wavelengths, key=None):
+    """As set_grid, but only returns the WavelengthGrid, leaving the global 
+    grid alone"""
+    new_wavelengths = np.asarray(new_wavelengths)
+    if key is None:
+        key = new_wavelengths.tobytes()
+    elif isinstance(key, str):
+        key = key.encode()
+    key = hashlib.sha1(key).hexdigest() + str(len(new_wavelengths))
+
+    if key not in grid_cache:
+        grid_cache[key] = WavelengthGrid(new_wavelengths)
+    return grid_cache[key]
+
+def current_grid():
+    """Output: WavelengthGrid for the global wavelengths, rebuilt if they were
+    reassigned directly rather than through get_bands or set_grid"""
+    if grid is None or grid.nm is not wavelengths:
+        return set_grid(wavelengths)
+    return grid
+
+def band_binning_benchmark(header_wavelengths, factors=(1, 2, 4, 8), 
+                           temperatures=np.linspace(1200, 2400, 13), noise=0.01,
+                           repeats=8, seed=0):
+    """Compares the temperature accuracy and fit time of band binning factors
+    on synthetic spectra of known temperature with relative Gaussian noise, 
+    generated on every header band so binning averages the noise as on data
+    Input: header_wavelengths (nm), factors: band_bin values to compare,
+            temperatures: true temperatures in K, noise: relative noise per 
+            header band, repeats: noisy spectra per temperature, seed
+    Output: dict of factor -> (fitted bands, median and 90th percentile 
+            |T error| in K, mean function evaluations, milliseconds per fit)"""
+    rng = np.random.default_rng(seed)
+    true = np.tile([0.5, -2e5, 0, 0, 0], (len(temperatures) * repeats, 1)).astype(np.float64)
+    true[:, 4] = np.repeat(temperatures, repeats)
+    spectra = planck_model(true, WavelengthGrid(header_wavelengths))
+    spectra = spectra * (1 + rng.normal(0, noise, spectra.shape))
+
+    results = dict()
+    for factor in factors:
+        selection = select_bands(header_wavelengths, bin_factor=factor)
+        start = perf_counter()
+        params, _, nfev, status = fit_batch(apply_bands(spectra, selection), quiet=True,
+                                            grid=cached_grid(selection["wavelengths"]))
+        elapsed = perf_counter() - start
+        error = np.where(status >= 0, np.abs(params[:, 4] - true[:, 4]), np.nan)
+        results[factor] = (len(selection["starts"]), np.nanmedian(error), 
+                           np.nanpercentile(error, 90), np.mean(nfev), 
+                           1e3 * elapsed / len(spectra))
+        print(f"bin {factor}: {results[factor][0]} bands, |T error| median "
+              f"{results[factor][1]:.1f} K, 90% {results[factor][2]:.1f} K, "
+              f"{results[factor][3]:.1f} evaluations, {results[factor][4]:.2f} ms per fit")
+    return results
+
+### Planck Model ###
+
+def planck_model(params, grid, scaled=False):
+    """Planck intensity with a quadratic emissivity and stray light offset,
+    evaluated over the whole wavelength grid at once
+    Input: params: [a0, a1, a2, offset, T] or an (N, 5) stack of them, 
+            grid: WavelengthGrid, scaled: whether params are 
+            [b0, b1, b2, offset, T] (see WavelengthGrid.scaled_params)
+    Output: array of modelled intensities, (bands,) or (N, bands)"""
+    params = np.asarray(params, dtype=np.float64) if scaled else grid.scaled_params(params)
+    e = params[..., :3] @ grid.vandermonde.T
+    T, offset = params[..., 4, None], params[..., 3, None]
+    return (e * grid.radiance / np.expm1(grid.exponent / T)) + offset
 
-def fit_spectrum(quiet=False, check_units=True):
+def planck_jacobian(params, grid, scaled=False):
+    """Closed-form Jacobian of planck_model with respect to the fit parameters
+    Input: params: [a0, a1, a2, offset, T] or an (N, 5) stack of them, 
+            grid: WavelengthGrid, scaled: as in planck_model
+    Output: (bands, 5) or (N, bands, 5) array of partial derivatives for 
+            [a0, a1, a2, offset, T], or [b0, b1, b2, offset, T] if scaled"""
+    b = np.asarray(params, dtype=np.float64) if scaled else grid.scaled_params(params)
+    if _use_numba():
+        p = np.ascontiguousarray(np.reshape(b, (-1, 5)))
+        jac = np.empty((len(p), len(grid), 5))
+        _numba_jacobian(p, grid.radiance, grid.exponent, grid.u, jac)
+        jac = jac.reshape(np.shape(b)[:-1] + (len(grid), 5))
+    else:
+        e = b[..., :3] @ grid.vandermonde.T
+        T = b[..., 4, None]
+        x = grid.exponent / T
+        em1 = np.expm1(x)
+        planck = grid.radiance / em1
+
+        jac = np.empty(planck.shape + (5,))
+        np.multiply(planck[..., None], grid.vandermonde, out=jac[..., :3])
+        jac[..., 3] = 1
+        # d/dT of 1/(exp(x)-1) with x = hc/(lkT) is exp(x)/(exp(x)-1)^2 * x/T
+        jac[..., 4] = e * planck * ((em1 + 1) / em1) * (x / T)
+    if not scaled:
+        # a0, a1 and a2 move e by 1, l and l**2
+        jac[..., 1] = jac[..., 0] * grid.l
+        jac[..., 2] = jac[..., 0] * grid.l**2
+    return jac
+
+def planck_residuals(params, grid, spectra, scaled=False):
+    """Input: params and scaled as in planck_model, grid: WavelengthGrid, 
+            spectra: matching (bands,) or (N, bands) measured intensities
+    Output: planck_model(params, grid) - spectra, from the kernel backend"""
+    if _use_numba():
+        b = np.asarray(params, dtype=np.float64) if scaled else grid.scaled_params(params)
+        p = np.ascontiguousarray(np.reshape(b, (-1, 5)))
+        measured = np.ascontiguousarray(np.broadcast_to(spectra, (len(p), len(grid))), 
+                                        dtype=np.float64)
+        resid = np.empty((len(p), len(grid)))
+        _numba_residuals(p, grid.radiance, grid.exponent, grid.u, measured, resid)
+        return resid.reshape(np.shape(b)[:-1] + (len(grid),))
+    return planck_model(params, grid, scaled=scaled) - spectra
+
+### Kernel Backends ###
+
+def set_kernel_backend(name):
+    """Chooses how planck_residuals and planck_jacobian are computed
+    Input: "numpy", or "numba" for loops compiled at import, which fuse each
+            evaluation into one pass with no temporary arrays (falls back to
+            "numpy" when Numba is not installed)
+    Output: the backend now in use"""
+    global kernel_backend
+    if name not in ("numpy", "numba"):
+        raise ValueError(f"Unknown kernel backend {name}")
+    if name == "numba" and numba is None:
+        print("Numba is not installed, using the numpy kernels...")
+        name = "numpy"
+    kernel_backend = name
+    return kernel_backend
+
+def _use_numba():
+    return kernel_backend == "numba" and numba is not None
+
+if numba is not None:
+    _vector = numba.types.Array(numba.float64, 1, "C")
+    _matrix = numba.types.Array(numba.float64, 2, "C")
+    # Measured spectra may be broadcast or memory-mapped views, so read-only
+    # arrays get their own compiled version
+    _measured = (_matrix, numba.types.Array(numba.float64, 2, "C", readonly=True))
+
+    @numba.njit([numba.void(_matrix, _vector, _vector, _vector, measured, _matrix) 
+                 for measured in _measured], cache=True)
+    def _numba_residuals(params, radiance, exponent, u, spectra, out):
+        for n in range(params.shape[0]):
+            b0, b1, b2, offset, T = params[n, 0], params[n, 1], params[n, 2], params[n, 3], params[n, 4]
+            for i in range(u.shape[0]):
+                e = b0 + b1 * u[i] + b2 * u[i] * u[i]
+                out[n, i] = e * radiance[i] / math.expm1(exponent[i] / T) + offset - spectra[n, i]
+
+    @numba.njit(numba.void(_matrix, _vector, _vector, _vector, 
+                           numba.types.Array(numba.float64, 3, "C")), cache=True)
+    def _numba_jacobian(params, radiance, exponent, u, out):
+        for n in range(params.shape[0]):
+            b0, b1, b2, T = params[n, 0], params[n, 1], params[n, 2], params[n, 4]
+            for i in range(u.shape[0]):
+                e = b0 + b1 * u[i] + b2 * u[i] * u[i]
+                x = exponent[i] / T
+                em1 = math.expm1(x)
+                planck = radiance[i] / em1
+                out[n, i, 0] = planck
+                out[n, i, 1] = planck * u[i]
+                out[n, i, 2] = planck * u[i] * u[i]
+                out[n, i, 3] = 1.0
+                out[n, i, 4] = e * planck * ((em1 + 1) / em1) * (x / T)
+
+def kernel_benchmark(folder_path, chunk_size=10, repeats=5):
+    """Times each available kernel backend on the pixels of a capture that
+    analysis would fit (see hot_mask): one residual and one Jacobian 
+    evaluation over all of them, and a whole fit_batch, comparing the fitted
+    temperatures. Rounding differences can send a few noisy pixels to a 
+    different minimum along the T-emissivity degeneracy, so the fraction of
+    pixels that differ is reported rather than the largest difference
+    Input: path to the image folder, chunk_size: pixels averaged along frames
+            and positions, as in analysis, repeats: evaluations timed per kernel
+    Output: dict of backend -> (ms per residual evaluation, ms per Jacobian, 
+            s per fit_batch, median |T - T of the numpy backend|, fraction of
+            pixels differing by more than 1 K)"""
+    paths = construct_paths(folder_path)
+    header_wavelengths, _, block = read_header_bands(paths[0])
+    cube, _ = read_capture(paths, bins=None if chunk_size == 1 else (chunk_size, chunk_size, 1))
+    selection = select_bands(header_wavelengths)
+    grid = cached_grid(selection["wavelengths"], key=grid_key(block, selection))
+    cube = apply_bands(cube, selection)
+    spectra = np.array(cube[hot_mask(cube, quiet=True, grid=grid)], dtype=np.float64)
+    params = np.tile(cold_params0, (len(spectra), 1)).astype(np.float64)
+
+    saved = kernel_backend
+    results, reference = dict(), None
+    try:
+        for name in ["numpy"] + (["numba"] if numba is not None else []):
+            set_kernel_backend(name)
+            planck_residuals(params, grid, spectra), planck_jacobian(params, grid)
+            start = perf_counter()
+            for _ in range(repeats):
+                planck_residuals(params, grid, spectra)
+            t_resid = perf_counter() - start
+            start = perf_counter()
+            for _ in range(repeats):
+                planck_jacobian(params, grid)
+            t_jac = perf_counter() - start
+            start = perf_counter()
+            fitted = fit_batch(spectra, quiet=True, grid=grid)[0]
+            t_fit = perf_counter() - start
+            if reference is None:
+                reference = fitted[:, 4]
+            difference = np.abs(fitted[:, 4] - reference)
+            results[name] = (1e3 * t_resid / repeats, 1e3 * t_jac / repeats, t_fit, 
+                             np.nanmedian(difference), np.mean(~(difference <= 1)))
+            print(f"{name}: residuals {results[name][0]:.2f} ms, Jacobian {results[name][1]:.2f} ms, "
+                  f"fit_batch {results[name][2]:.2f} s for {len(spectra)} pixels, "
+                  f"median |T difference| {results[name][3]:.2g} K, "
+                  f"{results[name][4]:.1%} differ by over 1 K")
+    finally:
+        set_kernel_backend(saved)
+    return results
+
+def fit_spectrum(quiet=False, check_units=True, params0=None, full_output=False,
+                 spectrum=None, grid=None):
     """Fits the selected spectrum
-    Input: None (uses global variables)
+    Input: None (uses global variables), params0: optional initial guess for 
+            [a0, a1, a2, offset, T], by default cold_start's, full_output: return the whole least_squares 
+            result (with nfev and status) instead of its parameters and cost,
+            spectrum, grid: spectrum and WavelengthGrid to fit instead of the
+            global ones
     Output: Fitted parameters, final least squares cost"""
     if check_units:
         print("\nIf this test fails, check lower in this function to adjust wavelenght unit conversion to m")
@@ -142,29 +934,44 @@ def fit_spectrum(quiet=False, check_units=True):
         print("Fitting spectrum...")
 
     # params = [a0, a1, a2, offset, T]
-    params0 = np.array([1, 1, 1, 0.1, 1000])
-    def intensity(params, l):
-        e = params[0] + (params[1] * l) + (params[2] * l**2)
-        return blackbody(l, params[4], e, params[3])
-    
+    if spectrum is None:
+        spectrum = globals()["spectrum"]
+    if grid is None:
+        grid = current_grid()
+    if params0 is None:
+        params0 = cold_start(np.asarray(spectrum)[None], grid=grid)[0]
+
+    # Fitted with the emissivity polynomial in u (see WavelengthGrid)
     def residuals(params):
-        result = []
-        for i in range(len(wavelengths)):
-            Si = intensity(params, wavelengths[i] * 1e-9) # assuming units are nm
-            St = spectrum[i]
-            result.append(Si - St)
-        return np.array(result)
+        return planck_residuals(params, grid, spectrum, scaled=True)
+
+    def jacobian(params):
+        return planck_jacobian(params, grid, scaled=True)
 
-    result = least_squares(residuals, params0)
+    # In counts the emissivity coefficients are ~1e-12 and T ~1e3, so the
+    # Jacobian columns still differ by ~14 orders of magnitude and are 
+    # scaled (x_scale="jac"). From a poor guess that can still drop T until
+    # the Planck term vanishes and only the offset is fitted; those fits are
+    # redone with finite differences, as the original unscaled fit did
+    start = grid.scaled_params(params0)
+    try:
+        result = least_squares(residuals, start, jac=jacobian, x_scale="jac")
+        scaled_nfev = result.nfev
+    except ValueError:
+        result, scaled_nfev = None, 0
+    if result is None or diverged(result.x, result.status):
+        result = least_squares(lambda params: planck_residuals(params, grid, spectrum), 
+                               params0)
+        result.nfev += scaled_nfev
+    else:
+        result.x = grid.unscaled_params(result.x)
 
     if not quiet:
-        yfit = []
-        for l in wavelengths:
-            yfit.append(intensity(result.x, l * 1e-9))
+        yfit = planck_model(result.x, grid)
 
         plt.figure(figsize=(5,5))
-        plt.scatter(wavelengths, spectrum, s=5)
-        plt.scatter(wavelengths, yfit, s=5)
+        plt.scatter(grid.nm, spectrum, s=5)
+        plt.scatter(grid.nm, yfit, s=5)
         plt.title(f"Fitted Spectrum for Position ({pixel[0]}, {pixel[1]})", fontsize=15)
         plt.xlabel(f"Wavelength [{units}]", fontsize=12)
         plt.xticks(fontsize=10)
@@ -173,46 +980,1501 @@ def fit_spectrum(quiet=False, check_units=True):
         plt.legend(["Actual", "Fitted"], fontsize=10)
         plt.show()
 
+    if full_output:
+        return result
     return result.x, result.cost
 
+def fit_batch(spectra, params0=None, max_iter=500, ftol=1e-8, xtol=1e-8, 
+              gtol=1e-8, quiet=False, grid=None):
+    """Fits many spectra at once with Levenberg-Marquardt iterations run on 
+    stacked arrays, so every pixel of an image advances in the same NumPy calls.
+    The steps follow the same trust region rules, and the same Jacobian 
+    column scaling (x_scale="jac"), as least_squares in fit_spectrum, so the 
+    two agree to within the solver tolerances (see solver_agreement_check).
+    As there, spectra whose fit fails or collapses below min_plausible_T are
+    refitted one at a time with finite differences, and marked failed if 
+    that does not give a plausible temperature either
+    Input: spectra: (N, bands) array of spectra on the wavelength grid,
+            params0: initial [a0, a1, a2, offset, T] shared by all spectra or an 
+            (N, 5) array of per-spectrum initial guesses, None or rows of NaN
+            for a cold start (see cold_start),
+            max_iter: maximum number of LM iterations,
+            ftol, xtol, gtol: convergence tolerances on cost, step and gradient,
+            grid: WavelengthGrid of the spectra, None for the global one
+    Output: (N, 5) fitted parameters, (N,) final costs, (N,) model evaluations,
+            (N,) status (1 converged, 0 hit max_iter, -1 failed)"""
+    if not quiet:
+        print(f"Fitting {len(spectra)} spectra in a batch...")
+    if grid is None:
+        grid = current_grid()
+    spectra = np.asarray(spectra, dtype=np.float64)
+    if params0 is None:
+        params0 = np.nan
+    params0 = np.array(np.broadcast_to(params0, (len(spectra), 5)), dtype=np.float64)
+    cold = ~np.all(np.isfinite(params0), axis=1)
+    if np.any(cold):
+        params0[cold] = cold_start(spectra[cold], grid=grid)
+    # Fitted with the emissivity polynomial in u (see WavelengthGrid)
+    params = grid.scaled_params(params0)
+
+    # Diverging pixels overflow the exponential; they are caught by the 
+    # finiteness checks below rather than reported as warnings
+    with np.errstate(all="ignore"):
+        cost, nfev, status = _lm_iterations(spectra, params, grid, max_iter, ftol, xtol, gtol)
+
+        for i in np.flatnonzero(diverged(params, status)):
+            try:
+                result = least_squares(lambda p: planck_residuals(p, grid, spectra[i]), 
+                                       params0[i])
+            except ValueError:
+                status[i] = -1
+                continue
+            params[i], cost[i] = grid.scaled_params(result.x), result.cost
+            status[i] = -1 if diverged(result.x, 1) else min(result.status, 1)
+            nfev[i] += result.nfev
+
+    if not quiet:
+        print(f"{np.sum(status == 1)} of {len(spectra)} spectra converged")
+    return grid.unscaled_params(params), cost, nfev, status
+
+def _lm_step(u_res, s, vt, radius):
+    """Solves the LM subproblem min ||J p + r|| subject to ||p|| <= radius for a
+    stack of pixels, given the SVD of each Jacobian (J = U diag(s) Vt) and 
+    u_res = U^T r. The damping for each pixel is found with a few safeguarded 
+    Newton iterations on the step length (More, 1978)
+    Output: (n, 5) steps"""
+    su = s * u_res
+    s2 = s**2
+
+    def step_norm(damping):
+        return np.sqrt(np.sum((su / (s2 + damping[:, None]))**2, axis=1))
+
+    def step(damping):
+        return -np.einsum("nji,nj->ni", vt, su / (s2 + damping[:, None]))
+
+    # Gauss-Newton step wherever it already fits in the trust region
+    full_rank = s[:, -1] > s[:, 0] * 1e-15
+    damping = np.where(full_rank, 0.0, 1e-300)
+    norm = step_norm(damping)
+    inside = full_rank & (norm <= radius)
+
+    lower = np.zeros_like(radius)
+    dphi = -np.sum(su**2 / (s2 + damping[:, None])**3, axis=1) / norm
+    lower[full_rank] = -((norm - radius) / dphi)[full_rank]
+    upper = np.sqrt(np.sum(su**2, axis=1)) / radius
+    damping = np.maximum(1e-3 * upper, np.sqrt(lower * upper))
+    for _ in range(10):
+        reset = (damping < lower) | (damping > upper)
+        damping[reset] = np.maximum(1e-3 * upper, np.sqrt(lower * upper))[reset]
+        norm = step_norm(damping)
+        phi = norm - radius
+        dphi = -np.sum(su**2 / (s2 + damping[:, None])**3, axis=1) / norm
+        upper = np.where(phi < 0, damping, upper)
+        ratio = phi / dphi
+        lower = np.maximum(lower, damping - ratio)
+        damping = damping - (phi + radius) * ratio / radius
+
+    damping[inside] = 0
+    return step(damping)
+
+def _jac_scale(jac, scale_inv=None):
+    """Per pixel column norms of (n, bands, 5) Jacobians, the x_scale="jac"
+    scaling of least_squares: each parameter is measured in units of how 
+    strongly it moves the model, never shrinking from one iteration to the next
+    Output: (n, 5) inverse scales"""
+    norms = np.linalg.norm(jac, axis=1)
+    norms[norms == 0] = 1
+    return norms if scale_inv is None else np.maximum(scale_inv, norms)
+
+def _lm_iterations(spectra, params, grid, max_iter, ftol, xtol, gtol):
+    """Trust region LM loop behind fit_batch; updates params, which are 
+    [b0, b1, b2, offset, T] (see WavelengthGrid.scaled_params), in place
+    Output: (N,) costs, (N,) model evaluations, (N,) status"""
+    n = len(spectra)
+    resid = planck_residuals(params, grid, spectra, scaled=True)
+    cost = 0.5 * np.sum(resid**2, axis=1)
+    nfev = np.ones(n, dtype=np.int64)
+    status = np.zeros(n, dtype=np.int64)
+
+    # Pixels still being iterated on; converged or failed ones drop out
+    status[~np.isfinite(cost)] = -1
+    active = np.flatnonzero(np.isfinite(cost))
+    jac = planck_jacobian(params[active], grid, scaled=True)
+
+    # Trust regions are measured in the scaled parameters, as in 
+    # fit_spectrum; unscaled, T takes steps 1e14 times too small
+    scale_inv = np.ones((n, 5))
+    with np.errstate(invalid="ignore"):
+        scale_inv[active] = _jac_scale(jac)
+    scale_inv[~np.isfinite(scale_inv)] = 1
+    radius = np.linalg.norm(params * scale_inv, axis=1)
+    radius[~(radius > 0) | ~np.isfinite(radius)] = 1
+
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        finite = np.all(np.isfinite(jac), axis=(1, 2))
+        if not np.all(finite):
+            status[active[~finite]] = -1
+            active, jac = active[finite], jac[finite]
+            continue
+
+        p, r, f = params[active], resid[active], cost[active]
+        grad = np.matmul(r[:, None, :], jac)[:, 0]
+        done = np.max(np.abs(grad), axis=1) < gtol
+
+        # The SVD of the (pixels, bands, 5) scaled Jacobian gives the same 
+        # steps as the (pixels, 5, 5) damped normal equations without 
+        # squaring their condition number
+        d = 1 / scale_inv[active]
+        u, s, vt = np.linalg.svd(jac * d[:, None, :], full_matrices=False)
+        step_h = _lm_step(np.matmul(r[:, None, :], u)[:, 0], s, vt, radius[active])
+        step = d * step_h
+
+        trial = p + step
+        trial_resid = planck_residuals(trial, grid, spectra[active], scaled=True)
+        trial_cost = 0.5 * np.sum(trial_resid**2, axis=1)
+        nfev[active] += 1
+
+        # Grow or shrink each trust region by how well the linear model 
+        # predicted the actual reduction in cost
+        jstep = np.matmul(jac, step[:, :, None])[:, :, 0]
+        predicted = -(np.sum(grad * step, axis=1) + 0.5 * np.sum(jstep**2, axis=1))
+        actual = f - trial_cost
+        ratio = np.where(predicted > 0, actual / predicted, 0)
+        ratio[~np.isfinite(trial_cost)] = 0
+        step_h_norm = np.linalg.norm(step_h, axis=1)
+        new_radius = np.where(ratio < 0.25, 0.25 * step_h_norm, radius[active])
+        grow = (ratio > 0.75) & (step_h_norm >= 0.95 * radius[active])
+        new_radius[grow] = 2 * radius[active][grow]
+        radius[active] = new_radius
+        step_norm = np.linalg.norm(step, axis=1)
+
+        better = np.isfinite(trial_cost) & (actual > 0)
+        idx = active[better]
+        params[idx] = trial[better]
+        resid[idx] = trial_resid[better]
+        cost[idx] = trial_cost[better]
+
+        small_drop = better & (actual < ftol * f) & (ratio > 0.25)
+        small_step = step_norm < xtol * (xtol + np.linalg.norm(p, axis=1))
+        collapsed = radius[active] <= 1e-300
+        done |= small_drop | small_step | collapsed
+        status[active[done]] = 1
+
+        # Only accepted pixels need a new Jacobian
+        keep = ~done
+        active = active[keep]
+        jac = jac[keep]
+        refresh = better[keep]
+        if np.any(refresh):
+            jac[refresh] = planck_jacobian(params[active[refresh]], grid, scaled=True)
+            scale_inv[active[refresh]] = _jac_scale(jac[refresh], scale_inv[active[refresh]])
+
+    return cost, nfev, status
+
+def solver_agreement_check(header_wavelengths, temperatures=np.linspace(1200, 2400, 13), 
+                           noise=0.01, repeats=4, tolerance=1.0, seed=0):
+    """Checks that fit_batch matches fit_spectrum pixel by pixel, on synthetic 
+    spectra of known temperature with relative Gaussian noise, both solvers
+    starting from the same cold_start guesses
+    Input: header_wavelengths (nm), temperatures: true temperatures in K, 
+            noise: relative noise per band, repeats: noisy spectra per 
+            temperature, tolerance: largest allowed |T difference| in K, seed
+    Output: largest |T difference| in K, ms per spectrum of fit_batch and of
+            fit_spectrum; fails an assertion if a spectrum converges in only
+            one solver or their temperatures differ by more than tolerance"""
+    rng = np.random.default_rng(seed)
+    selection = select_bands(header_wavelengths)
+    check_grid = cached_grid(selection["wavelengths"])
+    true = np.tile([0.5, -2e5, 0, 0, 0], (len(temperatures) * repeats, 1)).astype(np.float64)
+    true[:, 4] = np.repeat(temperatures, repeats)
+    spectra = planck_model(true, check_grid)
+    spectra = spectra * (1 + rng.normal(0, noise, spectra.shape))
+    params0 = cold_start(spectra, grid=check_grid)
+
+    start = perf_counter()
+    batched, _, _, status = fit_batch(spectra, params0, quiet=True, grid=check_grid)
+    t_batch = perf_counter() - start
+    start = perf_counter()
+    results = [fit_spectrum(quiet=True, check_units=False, params0=p, full_output=True,
+                            spectrum=s, grid=check_grid) for p, s in zip(params0, spectra)]
+    t_pixel = perf_counter() - start
+    pixel = np.array([result.x for result in results])
+    pixel_status = np.array([min(result.status, 1) for result in results])
+
+    difference = np.abs(batched[:, 4] - pixel[:, 4])
+    print(f"fit_batch {1e3 * t_batch / len(spectra):.2f} ms, fit_spectrum "
+          f"{1e3 * t_pixel / len(spectra):.2f} ms per spectrum, largest |T difference| "
+          f"{np.max(difference):.3g} K over {len(spectra)} spectra")
+    print("Checking that both solvers converge on the same spectra... ", end="")
+    assert(np.array_equal(diverged(batched, status), diverged(pixel, pixel_status)))
+    print("Passed")
+    print(f"Checking that their temperatures agree within {tolerance} K... ", end="")
+    assert(np.all(difference[~diverged(pixel, pixel_status)] <= tolerance))
+    print("Passed")
+    return np.max(difference), 1e3 * t_batch / len(spectra), 1e3 * t_pixel / len(spectra)
+
+def fit_wien(spectra, emissivity="constant", quiet=False, grid=None):
+    """Closed-form temperature estimate from Wien's approximation, valid well
+    below ~3000 K over this wavelength range. With I = e C1/l^5 exp(-C2/(lT)),
+    ln(I l^5 / C1) = ln(e) - C2/(lT) is linear in 1/l, so every spectrum is 
+    solved by one weighted linear least squares with no iteration. Ignores the
+    stray light offset
+    Input: spectra: (N, bands) array on the wavelength grid,
+            emissivity: "constant", or "linear" to let ln(e) vary linearly 
+            with wavelength, grid: WavelengthGrid of the spectra, None for the
+            global one
+    Output: (N, 5) params [a0, a1, a2, offset, T] (a1 from linearizing the 
+            emissivity about the band center, a2 and offset zero), 
+            (N,) weighted RMS residual of the log-linear fit, 
+            (N,) status (1 solved, -1 too few positive bands)"""
+    if not quiet:
+        print(f"Estimating {len(spectra)} temperatures from Wien's approximation...")
+    if grid is None:
+        grid = current_grid()
+    spectra = np.asarray(spectra, dtype=np.float64)
+    columns = [np.ones_like(grid.l), -1 / grid.l]
+    if emissivity == "linear":
+        columns.append(grid.u)
+    design = np.stack(columns, axis=-1)
+    col_scale = np.max(np.abs(design), axis=0)
+    design = design / col_scale
+
+    # Noise in ln(I) goes as 1/I, so each band is weighted by its intensity;
+    # bands with no positive signal get no weight
+    positive = spectra > 0
+    weights = np.where(positive, spectra, 0)**2
+    y = np.log(np.where(positive, spectra, 1)) - grid.log_radiance
+
+    ata = np.einsum("nb,bi,bj->nij", weights, design, design)
+    aty = np.einsum("nb,bi,nb->ni", weights, design, y)
+    n_cols = design.shape[1]
+    solvable = np.sum(positive, axis=1) > n_cols
+    ata[~solvable] = np.eye(n_cols)
+    coeffs = np.linalg.solve(ata + 1e-12 * np.eye(n_cols), aty[:, :, None])[:, :, 0]
+
+    resid = y - coeffs @ design.T
+    rms = np.sqrt(np.sum(weights * resid**2, axis=1) 
+                  / np.maximum(np.sum(weights, axis=1), 1e-300))
+    coeffs = coeffs / col_scale
+
+    params = np.zeros((len(spectra), 5))
+    # Unsolvable, blank or NaN spectra give a zero or non-finite slope; they 
+    # are caught by the status below rather than reported as warnings
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        params[:, 4] = (h * c / k) / coeffs[:, 1]
+        params[:, 0] = np.exp(coeffs[:, 0])
+        if emissivity == "linear":
+            # ln(e) = c0 + c2 u, so e ~ e^c0 (1 + c2 u)
+            params[:, 1] = params[:, 0] * coeffs[:, 2]
+        params = grid.unscaled_params(params)
+
+    status = np.where(solvable & np.all(np.isfinite(params), axis=1), 1, -1)
+    rms[status < 0] = np.nan
+    return params, rms, status
+
+def cold_start(spectra, grid=None):
+    """Initial guesses for spectra with no seed: cold_params0 with its 
+    emissivity scale and offset fitted to each spectrum by linear least 
+    squares. As is, cold_params0 is ~1e11 times too bright and a third of 
+    batched fits collapse onto the offset. Wien estimates (see fit_wien) 
+    converge in fewer steps but, ignoring the offset, start dim pixels 
+    hundreds of K too hot, and the flat T-emissivity valley keeps them there
+    Input: (N, bands) spectra, grid: WavelengthGrid of the spectra, None for
+            the global one
+    Output: (N, 5) initial guesses"""
+    if grid is None:
+        grid = current_grid()
+    unit = planck_model(np.append(cold_params0[:3], [0, cold_params0[4]]), grid)
+    design = np.stack((unit / np.linalg.norm(unit), np.ones_like(unit)), axis=-1)
+    coeffs = np.asarray(spectra, dtype=np.float64) @ np.linalg.pinv(design).T
+
+    params = np.tile(cold_params0, (len(coeffs), 1)).astype(np.float64)
+    params[:, :3] *= coeffs[:, :1] / np.linalg.norm(unit)
+    params[:, 3] = coeffs[:, 1]
+    return params
+
+### Lookup Table ###
+
+def build_lut(directory, lut_wavelengths, T_range=(500, 3000), T_step=10,
+              slopes=np.linspace(-0.8, 0.8, 9), curvatures=np.linspace(-0.4, 0.4, 5)):
+    """Tabulates unit-normalized Planck spectra over a grid of temperatures and
+    emissivity shapes e(u) = 1 + slope u + curvature u^2, with u running from 
+    -1 to 1 across the band, and saves them for lookup with load_lut
+    Input: directory to write to, lut_wavelengths: the fitted wavelengths in nm
+            (the wavelengths of select_bands for the production camera), T_range, 
+            T_step: temperature grid in K, slopes, curvatures: emissivity grid
+    Output: None (writes spectra.npy and axes.npz to the directory)"""
+    print("Building spectral lookup table...")
+    lut_grid = WavelengthGrid(lut_wavelengths)
+    temps = np.arange(T_range[0], T_range[1] + T_step, T_step, dtype=np.float64)
+    u = lut_grid.u
+
+    shape = (len(temps), len(slopes), len(curvatures))
+    spectra = np.zeros(shape + (len(lut_grid),), dtype=np.float32)
+    norms = np.zeros(shape)
+    planck = lut_grid.radiance / np.expm1(lut_grid.exponent / temps[:, None])
+    for j, slope in enumerate(slopes):
+        for q, curvature in enumerate(curvatures):
+            e = 1 + slope * u + curvature * u**2
+            # Entries with a non-positive emissivity stay zero and never match
+            if np.min(e) <= 0:
+                continue
+            template = planck * e
+            norms[:, j, q] = np.linalg.norm(template, axis=1)
+            spectra[:, j, q] = template / norms[:, j, q, None]
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "spectra.npy"), spectra.reshape(-1, len(lut_grid)))
+    np.savez(os.path.join(directory, "axes.npz"), wavelengths=lut_grid.nm, temps=temps,
+             slopes=np.asarray(slopes), curvatures=np.asarray(curvatures), norms=norms)
+    return None
+
+def load_lut(directory):
+    """Memory-maps a table written by build_lut, so processes share its pages
+    Input: directory of the table
+    Output: dict with the (entries, bands) spectra and its axes, or None if 
+            there is no table"""
+    if not os.path.isfile(os.path.join(directory, "spectra.npy")):
+        return None
+    table = dict(np.load(os.path.join(directory, "axes.npz")))
+    table["spectra"] = np.load(os.path.join(directory, "spectra.npy"), mmap_mode="r")
+    return table
+
+def fit_lut(spectra, table, chunk_size=512, grid=None):
+    """Inverts spectra by table lookup instead of optimization: each spectrum 
+    is matched to the tabulated shape with the highest cosine similarity, T is 
+    refined by a parabola through the neighbouring temperatures, and the 
+    emissivity scale comes from projecting onto the matched shape
+    Input: spectra: (N, bands) array on the wavelength grid, table: 
+            from load_lut, chunk_size: spectra matched per matrix product,
+            grid: WavelengthGrid of the spectra, None for the global one
+    Output: (N, 5) params [a0, a1, a2, offset, T] (offset zero), (N,) cosine
+            similarity of the match, (N,) status (1 matched, -1 no match)"""
+    lut_grid = current_grid() if grid is None else grid
+    temps, slopes, curvatures = table["temps"], table["slopes"], table["curvatures"]
+    shape = (len(temps), len(slopes), len(curvatures))
+    spectra = np.asarray(spectra, dtype=np.float64)
+
+    similarity = np.zeros(len(spectra))
+    best = np.zeros(len(spectra), dtype=np.int64)
+    for start in range(0, len(spectra), chunk_size):
+        chunk = spectra[start:start + chunk_size]
+        norm = np.linalg.norm(chunk, axis=1, keepdims=True)
+        scores = (chunk / np.where(norm > 0, norm, 1)) @ table["spectra"].T
+        best[start:start + chunk_size] = np.argmax(scores, axis=1)
+        similarity[start:start + chunk_size] = np.max(scores, axis=1)
+    i_T, i_s, i_q = np.unravel_index(best, shape)
+
+    # Parabolic interpolation of the similarity between neighbouring T entries
+    T = temps[i_T].copy()
+    inner = (i_T > 0) & (i_T < len(temps) - 1)
+    if np.any(inner):
+        rows = np.flatnonzero(inner)
+        neighbours = np.stack([np.ravel_multi_index((i_T[rows] + d, i_s[rows], i_q[rows]), shape) 
+                               for d in (-1, 0, 1)], axis=1)
+        scores = np.einsum("nb,nkb->nk", spectra[rows], table["spectra"][neighbours.ravel()]
+                           .reshape(len(rows), 3, -1))
+        curve = scores[:, 0] - 2 * scores[:, 1] + scores[:, 2]
+        shift = np.where(curve < 0, 0.5 * (scores[:, 0] - scores[:, 2]) / np.where(curve < 0, curve, 1), 0)
+        T[rows] += np.clip(shift, -0.5, 0.5) * (temps[1] - temps[0])
+
+    # Scale: spectrum ~ b0 * norm * shape, with e(u) converted to a 
+    # polynomial in wavelength to give [a0, a1, a2]. Blank spectra match 
+    # all-zero table entries, which have no scale and are left NaN to fail below
+    norms = table["norms"][i_T, i_s, i_q]
+    scaled = norms > 0
+    matched = np.asarray(table["spectra"][best[scaled]], dtype=np.float64)
+    scale = np.full(len(spectra), np.nan)
+    scale[scaled] = np.sum(spectra[scaled] * matched, axis=1) / norms[scaled]
+    params = np.zeros((len(spectra), 5))
+    params[:, 0] = scale
+    params[:, 1] = scale * slopes[i_s]
+    params[:, 2] = scale * curvatures[i_q]
+    params[:, 4] = T
+    params = lut_grid.unscaled_params(params)
+
+    status = np.where((similarity > 0) & np.all(np.isfinite(params), axis=1), 1, -1)
+    return params, similarity, status
+
+def lut_usable(table, grid=None):
+    """Output: whether a loaded table was built for the given wavelength grid,
+    by default the current one"""
+    if grid is None:
+        grid = current_grid()
+    return (table is not None and len(table["wavelengths"]) == len(grid) 
+            and np.allclose(table["wavelengths"], grid.nm))
+
+def fit_lut_image(cube, table, grid=None):
+    """Temperature map straight from the lookup table, with no optimization
+    Input: cube, table: from load_lut, grid: WavelengthGrid of the cube, None
+            for the global one
+    Output: fit maps as described in empty_fit_maps (residual holds 1 minus 
+            the cosine similarity of each match)"""
+    if grid is None:
+        grid = current_grid()
+    fit = empty_fit_maps(cube.shape[:2])
+    spectra = cube.reshape(-1, cube.shape[2])
+    params, similarity, status = fit_lut(spectra, table, grid=grid)
+    with np.errstate(all="ignore"):
+        cost = 0.5 * np.sum((planck_model(params, grid) - spectra)**2, axis=1)
+
+    fit["params"] = params.reshape(fit["params"].shape)
+    fit["cost"] = cost.reshape(fit["cost"].shape)
+    fit["status"] = status.reshape(fit["status"].shape)
+    fit["residual"] = (1 - similarity).reshape(fit["residual"].shape)
+    return fit
+
+# Mapped once at import, and by every pool worker (see worker_pool), so all
+# of them share the same pages
+lut = load_lut(lut_dir)
+
+### Hot Region Mask ###
+def hot_mask(cube, noise=None, averaged=1, min_fraction=1e-3, min_snr=5, 
+             T_range=(min_plausible_T, max_plausible_T), quiet=False, grid=None, brightest=None):
+    """Finds the pixels hot enough to measure, so the wall and cold rod are 
+    not fitted. A pixel is kept if its integrated intensity is at least 
+    min_fraction of the brightest pixel's and min_snr times its noise, and 
+    fit_wien gives it a temperature within T_range
+    Input: cube: in memory or a LazyCapture, which is read twice a block 
+            at a time, noise: per fitted band standard deviation of a single 
+            corrected pixel (see dark_noise), None to skip the SNR test, 
+            averaged: pixels averaged into each cube pixel (100 after 
+            shrink_image), min_fraction, min_snr, T_range: thresholds above,
+            grid: WavelengthGrid of the cube, None for the global one,
+            brightest: integrated intensity of the brightest pixel, None for 
+            the cube's own (see Analyzer.analyze_stream)
+    Output: (frames, positions) boolean mask of the pixels to fit"""
+    total = np.concatenate([np.sum(block, axis=2) for _, _, block in frame_blocks(cube)])
+    brightest = np.nanmax(total) if brightest is None else brightest
+    with np.errstate(invalid="ignore"):
+        mask = total >= min_fraction * brightest
+        if noise is not None:
+            mask &= total >= min_snr * np.sqrt(np.sum(noise**2) / averaged)
+
+    for start, end, block in frame_blocks(cube):
+        rows = mask[start:end]
+        if not rows.any():
+            continue
+        params, _, status = fit_wien(block[rows], quiet=True, grid=grid)
+        T = params[:, -1]
+        rows[rows] = (status > 0) & (T > T_range[0]) & (T < T_range[1])
+
+    if not quiet:
+        print(f"Hot region mask: fitting {np.sum(mask)} of {mask.size} pixels, "
+              f"skipping {1 - np.mean(mask):.1%}")
+    return mask
+
+def skip_background(fit, mask):
+    """Marks the pixels outside mask as background in fit maps
+    Input: fit maps (see empty_fit_maps), mask from hot_mask or None
+    Output: the same fit maps"""
+    if mask is None:
+        return fit
+    fit["params"][~mask] = np.nan
+    fit["cost"][~mask] = np.nan
+    fit["residual"][~mask] = np.nan
+    fit["nfev"][~mask] = 0
+    fit["status"][~mask] = background
+    return fit
+
+def skip_invalid(fit, valid):
+    """Marks the pixels outside valid, which correct_frames blanked, as 
+    failed in fit maps
+    Input: fit maps (see empty_fit_maps), mask from valid_pixels
+    Output: the same fit maps"""
+    fit = skip_background(fit, valid)
+    fit["status"][~valid] = -1
+    return fit
+
 ### Analysis ###
 
-def analysis(folder_path):
+def empty_fit_maps(shape):
+    """Input: (frames, positions) shape of a cube
+    Output: dict of per-pixel fit results: params, cost, nfev, status 
+            (1 converged, 0 hit iteration limit, -1 failed, background when 
+            skipped by hot_mask), seed (0 cold start,
+            else the seed_codes source used, -1 warm fit fell back to cold), 
+            residual (RMS log residual of the Wien estimate, NaN when not used),
+            block (side in pixels of the block the fit was made on, see 
+            fit_pyramid) and seed_nfev, the evaluations spent producing seeds"""
+    return {
+        "params": np.full(shape + (5,), np.nan),
+        "cost": np.full(shape, np.nan),
+        "nfev": np.zeros(shape, dtype=np.int64),
+        "status": np.full(shape, -1, dtype=np.int64),
+        "seed": np.zeros(shape, dtype=np.int64),
+        "residual": np.full(shape, np.nan),
+        "block": np.ones(shape, dtype=np.int64),
+        "seed_nfev": 0,
+    }
+
+def diverged(params, status):
+    """Input: (..., 5) fitted params and matching status codes
+    Output: mask of fits that did not converge to a plausible temperature,
+            between min_plausible_T and max_plausible_T"""
+    T = params[..., -1]
+    return ((status <= 0) | ~np.all(np.isfinite(params), axis=-1) 
+            | ~((T > min_plausible_T) & (T < max_plausible_T)))
+
+def converged_params(fit):
+    """Input: fit maps (see empty_fit_maps)
+    Output: their params, NaN wherever the fit did not converge, so a fit 
+            that stalled at the iteration limit never seeds another"""
+    return np.where(fit["status"][..., None] == 1, fit["params"], np.nan)
+
+def temperature_uncertainty(params, cost=None, noise=None, grid=None):
+    """Standard deviation of the fitted temperatures from the covariance 
+    (J^T W J)^-1 of the fit, which covers both the noise and the 
+    T-emissivity degeneracy
+    Input: (..., 5) fitted params, (...) their costs, to estimate the noise 
+            variance as 2 cost / (bands - 5), or noise: per band standard 
+            deviation of the spectra (see dark_noise), used instead if given,
+            grid: WavelengthGrid the spectra were fitted on, None for the 
+            global one
+    Output: (...) sigma_T in K, inf where the Jacobian is singular or not 
+            finite, NaN where the fit is"""
+    if grid is None:
+        grid = current_grid()
+    params = np.asarray(params, dtype=np.float64)
+    jac = planck_jacobian(grid.scaled_params(params), grid, scaled=True).reshape(-1, len(grid), 5)
+    if noise is None:
+        variance = 2 * np.ravel(cost) / (len(grid) - 5)
+    else:
+        # Weighting each band by its noise leaves unit variance
+        jac /= np.asarray(noise, dtype=np.float64)[:, None]
+        variance = np.ones(len(jac))
+    finite = np.all(np.isfinite(jac), axis=(1, 2))
+    jac[~finite] = 1
+    # Normalizing the columns first keeps the SVD well conditioned although 
+    # the T column is ~1e14 times smaller than the emissivity ones
+    norms = np.linalg.norm(jac, axis=1)
+    norms[norms == 0] = 1
+    _, sv, vt = np.linalg.svd(jac / norms[:, None, :], full_matrices=False)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_T = np.sum((vt[:, :, 4] / sv)**2, axis=1) / norms[:, 4]**2
+        sigma = np.sqrt(var_T * variance)
+    sigma[~finite | (sv[:, -1] == 0)] = np.inf
+    sigma[~np.all(np.isfinite(params.reshape(-1, 5)), axis=1) | ~np.isfinite(variance)] = np.nan
+    return sigma.reshape(params.shape[:-1])
+
+def as_seed(params):
+    """Turns fitted params into an initial guess for a nearby fit. a1 and a2 are
+    poorly determined and steer the fit along the T-emissivity degeneracy 
+    (from lookup table seeds, keeping them leaves 11% rather than 7% of 
+    pixels over 50 K from their cold fit), so only a0, the offset and T are
+    carried over
+    Input: (..., 5) fitted params
+    Output: (..., 5) initial guesses"""
+    seed = np.array(params, dtype=np.float64)
+    seed[..., 1:3] = cold_params0[1:3]
+    return seed
+
+def block_means(cube, factor):
+    """Input: (frames, positions, bands) cube, factor: block size
+    Output: float32 cube averaged over factor x factor pixel blocks, the 
+            blocks on the bottom and right edges averaging whatever pixels 
+            remain and every block only its valid ones, those with no NaN 
+            band (correct_frames blanks whole spectra), NaN if it has none"""
+    rows = np.arange(0, cube.shape[0], factor)
+    cols = np.arange(0, cube.shape[1], factor)
+    # Validity and counts per pixel, and sums one row of blocks at a time, so
+    # nothing the size of the cube is allocated besides the result
+    valid = np.isfinite(np.sum(cube, axis=2, dtype=np.float32))
+    counts = np.add.reduceat(np.add.reduceat(valid.astype(np.float32), rows, axis=0), cols, axis=1)
+    coarse = np.empty((len(rows), len(cols), cube.shape[2]), dtype=np.float32)
+    for i, start in enumerate(rows):
+        sums = np.sum(cube[start:start + factor], axis=0, dtype=np.float32, 
+                      where=valid[start:start + factor, :, None])
+        coarse[i] = np.add.reduceat(sums, cols, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        coarse /= counts[:, :, None]
+    return coarse
+
+def coarse_seeds(cube, solver, factor=2, grid=None):
+    """Fits a copy of the cube averaged over factor x factor pixel blocks and
+    spreads each block's parameters back over its pixels as initial guesses
+    Input: cube, solver: "pixel" or "batched", factor: block size, 
+            grid: WavelengthGrid of the cube, None for the global one
+    Output: (frames, positions, 5) seeds (NaN where the coarse fit failed),
+            evaluations spent on the coarse fit"""
+    coarse = block_means(cube, factor)
+    fit = fit_image(coarse, solver=solver, progress=False, warm_start=("neighbor",),
+                    grid=grid)
+    seeds = np.repeat(np.repeat(converged_params(fit), factor, axis=0), factor, axis=1)
+    return seeds[:cube.shape[0], :cube.shape[1]], int(np.sum(fit["nfev"])) + fit["seed_nfev"]
+
+def fit_wien_image(cube, emissivity="constant", refine_above=None, mask=None, 
+                   grid=None):
+    """Fast temperature map from fit_wien, optionally refining the pixels whose
+    Wien fit is poor with the full Planck model
+    Input: cube, emissivity: "constant" or "linear" (see fit_wien),
+            refine_above: Wien RMS log residual above which a pixel is refitted
+            with fit_batch, seeded from its Wien estimate; None to never refit,
+            mask: pixels to fit (see hot_mask), None for all, grid: 
+            WavelengthGrid of the cube, None for the global one
+    Output: fit maps as described in empty_fit_maps"""
+    if grid is None:
+        grid = current_grid()
+    fit = empty_fit_maps(cube.shape[:2])
+    spectra = cube.reshape(-1, cube.shape[2])
+    params, residual, status = fit_wien(spectra, emissivity=emissivity, quiet=True, grid=grid)
+    with np.errstate(all="ignore"):
+        cost = 0.5 * np.sum((planck_model(params, grid) - spectra)**2, axis=1)
+    nfev = np.zeros(len(spectra), dtype=np.int64)
+    source = np.zeros(len(spectra), dtype=np.int64)
+
+    if refine_above is not None:
+        refine = (status < 0) | ~(residual <= refine_above)
+        if mask is not None:
+            refine &= mask.ravel()
+        if np.any(refine):
+            print(f"Refining {np.sum(refine)} of {len(spectra)} pixels with the Planck fit...")
+            params0 = np.where(status[refine, None] > 0, as_seed(params[refine]), cold_params0)
+            refit = fit_batch(spectra[refine], params0, quiet=True, grid=grid)
+            params[refine], cost[refine], nfev[refine] = refit[0], refit[1], refit[2]
+            status[refine] = np.minimum(refit[3], 1)
+            source[refine] = np.where(status[refine] > 0, seed_codes["wien"], 0)
+
+    fit["params"] = params.reshape(fit["params"].shape)
+    fit["cost"] = cost.reshape(fit["cost"].shape)
+    fit["nfev"] = nfev.reshape(fit["nfev"].shape)
+    fit["status"] = status.reshape(fit["status"].shape)
+    fit["seed"] = source.reshape(fit["seed"].shape)
+    fit["residual"] = residual.reshape(fit["residual"].shape)
+    return skip_background(fit, mask)
+
+def fit_pyramid(cube, coarse_size=16, min_size=1, T_sigmas=0.5, 
+                cost_threshold=None, noise=None, mask=None, quiet=False, grid=None):
+    """Fits the cube coarse to fine: every coarse_size x coarse_size block is 
+    fitted first, then each block whose temperature differs from a neighbor's
+    by more than a single pixel's fit could resolve, or whose fit is poor, is
+    split into four and its children are refitted with fit_batch seeded from 
+    it, down to min_size
+    Input: cube: corrected full resolution image, coarse_size, min_size: block
+            sizes of the first and last levels, powers of two,
+            T_sigmas: temperature step between neighboring blocks above which
+            both are refined, in standard deviations of a single pixel's 
+            temperature at the better measured of their fits (see 
+            temperature_uncertainty), cost_threshold: fit cost relative to the
+            block spectrum's own 0.5 * sum(I^2) above which a block is refined;
+            None to refine on temperature steps and failed fits only,
+            noise: per band noise of one pixel of the cube (see dark_noise), 
+            None to estimate it from the residual of each block's fit,
+            mask: pixels to fit (see hot_mask), a block being fitted if any of
+            its pixels is; None for all, grid: WavelengthGrid of the cube, 
+            None for the global one
+    Output: fit maps as described in empty_fit_maps at full resolution, each 
+            pixel holding the fit of the smallest block covering it and each 
+            block's nfev counted once, on its top left pixel"""
+    if coarse_size < min_size or coarse_size & (coarse_size - 1) or min_size & (min_size - 1):
+        raise ValueError("coarse_size and min_size must be powers of two with coarse_size >= min_size")
+
+    shape = cube.shape[:2]
+    fit = empty_fit_maps(shape)
+    size = coarse_size
+    hot = np.ones(shape + (1,), dtype=np.float32) if mask is None else mask[:, :, None].astype(np.float32)
+    if noise is None:
+        valid = np.isfinite(np.sum(cube, axis=2, dtype=np.float32)).astype(np.int64)
+    sigma = np.full(shape, np.nan) # uncertainty of a pixel's T, see T_sigmas
+    active = block_means(hot, size)[:, :, 0] > 0
+    params0 = np.full(active.shape + (5,), np.nan) # cold starts
+    source = np.zeros(active.shape, dtype=np.int64)
+    n_fits = 0
+
+    while np.any(active):
+        spectra = block_means(cube, size)[active]
+        params, cost, nfev, status = fit_batch(spectra, params0[active], quiet=True, grid=grid)
+        seeded = source[active]
+        # A seed from a block averaged across a temperature step can also 
+        # converge onto the flat, offset-only fit, whose cost is orders of 
+        # magnitude above that of its neighbors
+        with np.errstate(invalid="ignore"):
+            energy = 0.5 * np.sum(spectra**2, axis=1)
+            poor = ~(cost <= 100 * np.nanmedian(cost / energy) * energy)
+        retry = (seeded > 0) & (diverged(params, status) | poor)
+        if np.any(retry):
+            refit = fit_batch(spectra[retry], quiet=True, grid=grid)
+            better = diverged(params[retry], status[retry]) | (refit[1] < cost[retry])
+            index = np.flatnonzero(retry)[better]
+            params[index], cost[index], status[index] = refit[0][better], refit[1][better], refit[3][better]
+            seeded[index] = -1
+            nfev[retry] += refit[2]
+        n_fits += len(spectra)
+        if not quiet:
+            print(f"{size}x{size} blocks: fitted {len(spectra)} of {active.size}")
+
+        level = empty_fit_maps(active.shape)
+        level["params"][active] = params
+        level["cost"][active] = cost
+        level["status"][active] = np.minimum(status, 1)
+        level["seed"][active] = seeded
+        level["sigma"] = np.full(active.shape, np.nan)
+        if noise is not None:
+            # What a single pixel at the block's fit would be measured to
+            level["sigma"][active] = temperature_uncertainty(params, noise=noise, grid=grid)
+        else:
+            # A block's fit averages the noise of its valid pixels, each of 
+            # which alone would have sqrt(pixels) times its uncertainty
+            pixels = np.add.reduceat(np.add.reduceat(valid, np.arange(0, shape[0], size), axis=0), 
+                                     np.arange(0, shape[1], size), axis=1)
+            level["sigma"][active] = (temperature_uncertainty(params, cost, grid=grid) 
+                                      * np.sqrt(pixels[active]))
+
+        # Paint this level over the coarser fits of the pixels it covers
+        covered = np.repeat(np.repeat(active, size, axis=0), size, axis=1)[:shape[0], :shape[1]]
+        for key in ("params", "cost", "status", "seed"):
+            painted = np.repeat(np.repeat(level[key], size, axis=0), size, axis=1)
+            fit[key][covered] = painted[:shape[0], :shape[1]][covered]
+        painted = np.repeat(np.repeat(level["sigma"], size, axis=0), size, axis=1)
+        sigma[covered] = painted[:shape[0], :shape[1]][covered]
+        fit["block"][covered] = size
+        fit["nfev"][::size, ::size][active] += nfev
+
+        if size <= min_size:
+            break
+
+        # Temperatures of every block at this level, refined or inherited
+        T = fit["params"][::size, ::size, -1]
+        T_sigma = sigma[::size, ::size]
+        refine = level["status"] < 1
+        with np.errstate(invalid="ignore"):
+            steps = np.abs(np.diff(T, axis=0)) > T_sigmas * np.fmin(T_sigma[1:], T_sigma[:-1])
+            refine[1:] |= steps
+            refine[:-1] |= steps
+            steps = np.abs(np.diff(T, axis=1)) > T_sigmas * np.fmin(T_sigma[:, 1:], T_sigma[:, :-1])
+            refine[:, 1:] |= steps
+            refine[:, :-1] |= steps
+            if cost_threshold is not None:
+                refine[active] |= ~(cost <= cost_threshold * energy)
+        refine &= active
+        if not np.any(refine):
+            break
+
+        # Children inherit their parent's fit as the initial guess
+        size //= 2
+        children = (-(-shape[0] // size), -(-shape[1] // size))
+        active = np.repeat(np.repeat(refine, 2, axis=0), 2, axis=1)[:children[0], :children[1]]
+        active &= block_means(hot, size)[:, :, 0] > 0
+        parents = np.repeat(np.repeat(level["params"], 2, axis=0), 2, axis=1)[:children[0], :children[1]]
+        parent_status = np.repeat(np.repeat(level["status"], 2, axis=0), 2, axis=1)[:children[0], :children[1]]
+        usable = (parent_status == 1) & ~diverged(parents, parent_status)
+        params0 = np.where(usable[:, :, None], as_seed(parents), np.nan)
+        source = np.where(usable, seed_codes["parent"], 0)
+
+    if not quiet:
+        print(f"Pyramid fit used {n_fits} fits for {shape[0] * shape[1]} pixels")
+    return skip_background(fit, mask)
+
+def fit_image(cube, solver="pixel", progress=True, warm_start=(), previous=None,
+              mask=None, grid=None, table=None):
+    """Fits every pixel of a (frames, positions, bands) cube
+    Input: cube: corrected (and usually shrunk) image on the fitted bands 
+            (see apply_bands), solver: "pixel", 
+            "batched", "wien" or "lut" (see analysis), progress: show a 
+            progress bar, warm_start: seed sources to try in priority order, 
+            any of "neighbor" (the already fitted pixel to the left or above; 
+            pixel solver only), "previous" (the same pixel of the previous 
+            capture), "coarse" (a fit of the image at half resolution) and 
+            "lut" (the lookup table estimate, see fit_lut; as it can lead to
+            a hotter minimum of higher cost, its pixels are also fitted cold
+            and keep the lower cost fit),
+            previous: (frames, positions, 5) params of the previous capture,
+            mask: pixels to fit (see hot_mask), None for all,
+            grid: WavelengthGrid of the cube, None for the global one,
+            table: lookup table, None for the global lut
+    Output: fit maps as described in empty_fit_maps"""
+    if grid is None:
+        grid = current_grid()
+    if table is None:
+        table = lut
+    # Pixels blanked by correct_frames count as failed without being fitted
+    valid = valid_pixels(cube)
+    if not valid.all():
+        mask = valid if mask is None else mask & valid
+
+    if solver == "wien":
+        return skip_invalid(fit_wien_image(cube, mask=mask, grid=grid), valid)
+    if solver == "lut":
+        return skip_invalid(skip_background(fit_lut_image(cube, table, grid=grid), mask), 
+                            valid)
+    if solver == "pyramid":
+        return skip_invalid(fit_pyramid(cube, mask=mask, quiet=True, grid=grid), valid)
+
+    fit = empty_fit_maps(cube.shape[:2])
+    seeds = dict()
+    if "previous" in warm_start and previous is not None and previous.shape[:2] == cube.shape[:2]:
+        seeds["previous"] = previous
+    if "coarse" in warm_start and min(cube.shape[:2]) > 1:
+        seeds["coarse"], fit["seed_nfev"] = coarse_seeds(cube, solver, grid=grid)
+    if "lut" in warm_start and lut_usable(table, grid):
+        lut_params, _, lut_status = fit_lut(cube.reshape(-1, cube.shape[2]), table, grid=grid)
+        lut_params[lut_status < 0] = np.nan
+        seeds["lut"] = lut_params.reshape(cube.shape[:2] + (5,))
+
+    if solver == "batched":
+        spectra = cube.reshape(-1, cube.shape[2])
+        params0 = np.full((len(spectra), 5), np.nan) # cold starts unless seeded
+        source = np.zeros(len(spectra), dtype=np.int64)
+        # Lowest priority first so higher priority sources overwrite it
+        for name in reversed(warm_start):
+            if name not in seeds:
+                continue
+            seed = as_seed(seeds[name].reshape(-1, 5))
+            usable = np.all(np.isfinite(seed), axis=1)
+            params0[usable] = seed[usable]
+            source[usable] = seed_codes[name]
+
+        selected = np.ones(len(spectra), dtype=bool) if mask is None else mask.ravel()
+        params = np.full((len(spectra), 5), np.nan)
+        cost = np.full(len(spectra), np.nan)
+        nfev = np.zeros(len(spectra), dtype=np.int64)
+        status = np.full(len(spectra), background, dtype=np.int64)
+        source[~selected] = 0
+        params[selected], cost[selected], nfev[selected], status[selected] = fit_batch(
+            spectra[selected], params0[selected], quiet=True, grid=grid)
+        retry = (source > 0) & diverged(params, status) & selected
+        if np.any(retry):
+            refit = fit_batch(spectra[retry], quiet=True, grid=grid)
+            params[retry], cost[retry], status[retry] = refit[0], refit[1], refit[3]
+            nfev[retry] += refit[2]
+            source[retry] = -1
+        # Lookup table seeds are checked against a cold fit, see above
+        check = (source == seed_codes["lut"]) & selected
+        if np.any(check):
+            refit = fit_batch(spectra[check], quiet=True, grid=grid)
+            better = ~diverged(refit[0], refit[3]) & (refit[1] < cost[check])
+            index = np.flatnonzero(check)[better]
+            params[index], cost[index], status[index] = refit[0][better], refit[1][better], refit[3][better]
+            nfev[check] += refit[2]
+            source[index] = -1
+
+        fit["params"] = params.reshape(fit["params"].shape)
+        fit["cost"] = cost.reshape(fit["cost"].shape)
+        fit["nfev"] = nfev.reshape(fit["nfev"].shape)
+        fit["status"] = np.minimum(status, 1).reshape(fit["status"].shape)
+        fit["seed"] = source.reshape(fit["seed"].shape)
+        return skip_invalid(fit, valid)
+
+    pixels = itertools.product if progress else product
+    for (i,j) in pixels(range(cube.shape[0]), range(cube.shape[1])):
+        spectrum = cube[i][j]
+        if mask is not None and not mask[i, j]:
+            fit["status"][i, j] = background
+            continue
+
+        seed, source = None, 0
+        for name in warm_start:
+            if name == "neighbor":
+                neighbors = [(i, j - 1), (i - 1, j)]
+                candidates = [fit["params"][n] for n in neighbors 
+                              if min(n) >= 0 and fit["status"][n] == 1]
+            else:
+                candidates = [seeds[name][i, j]] if name in seeds else []
+            candidates = [p for p in candidates if np.all(np.isfinite(p))]
+            if len(candidates) > 0:
+                seed, source = as_seed(candidates[0]), seed_codes[name]
+                break
+
+        nfev, result = 0, None
+        try:
+            if seed is not None:
+                try:
+                    result = fit_spectrum(quiet=True, check_units=False, params0=seed, 
+                                          full_output=True, spectrum=spectrum, grid=grid)
+                    nfev += result.nfev
+                    if diverged(result.x, result.status):
+                        result = None
+                except Exception:
+                    result = None
+                if result is None:
+                    source = -1
+            # Lookup table seeds are checked against a cold fit, see above
+            if result is None or source == seed_codes["lut"]:
+                cold = fit_spectrum(quiet=True, check_units=False, full_output=True,
+                                    spectrum=spectrum, grid=grid)
+                nfev += cold.nfev
+                if result is None:
+                    result = cold
+                elif not diverged(cold.x, cold.status) and cold.cost < result.cost:
+                    result, source = cold, -1
+            fit["params"][i, j] = result.x
+            fit["cost"][i, j] = result.cost
+            fit["status"][i, j] = min(result.status, 1)
+        except: fit["status"][i, j] = -1
+        fit["nfev"][i, j] = nfev
+        fit["seed"][i, j] = source
+
+    return skip_invalid(fit, valid)
+
+def warm_start_report(fit, quiet=False, reference=None):
+    """Estimates the function evaluations saved by warm starts, taking the mean
+    cost of every cold fit seen so far as what each warm started pixel would 
+    otherwise have cost
+    Input: fit maps from fit_image, reference: [total evaluations, count] of
+            the cold fits seen so far, updated in place; None for the global 
+            cold_nfev_reference
+    Output: estimated evaluations saved, or None if there is no reference"""
+    if reference is None:
+        reference = cold_nfev_reference
+    cold = (fit["seed"] == 0) & (fit["status"] >= 0)
+    warm = fit["seed"] != 0
+    reference[0] += int(np.sum(fit["nfev"][cold]))
+    reference[1] += int(np.sum(cold))
+    if not np.any(warm) or reference[1] == 0:
+        return None
+
+    mean_cold = reference[0] / reference[1]
+    saved = mean_cold * np.sum(warm) - np.sum(fit["nfev"][warm]) - fit["seed_nfev"]
+    if not quiet:
+        print(f"Warm started {np.sum(fit['seed'] > 0)} of {fit['seed'].size} pixels "
+              f"({np.sum(fit['seed'] == -1)} fell back to a cold start), "
+              f"saving about {int(saved)} function evaluations")
+    return saved
+
+def _fit_tile(source, row_start, row_end, solver, warm_start, previous, mask, grid, 
+              table):
+    """Pool task: fits rows [row_start, row_end) of the image, either a 
+    LazyCapture mapped from disk, which the worker reads and corrects itself,
+    ("cube", name, shape, dtype) of the image held in shared memory or
+    ("files", name, layout, headers, paths, selection) of a capture whose 
+    files were received in memory (see _share_files), so neither the cube 
+    nor the files are pickled to the workers; the small WavelengthGrid 
+    travels with each task
+    Output: (row_start, fit maps for the tile)"""
+    if isinstance(source, LazyCapture):
+        fit = fit_image(source[row_start:row_end], solver=solver, progress=False,
+                        warm_start=warm_start, previous=previous, mask=mask, grid=grid, 
+                        table=table)
+        return row_start, fit
+    shm = shared_memory.SharedMemory(name=source[1])
+    if source[0] == "cube":
+        cube = np.ndarray(source[2], dtype=source[3], buffer=shm.buf)
+    else:
+        layout, headers, paths, selection = source[2:]
+        files = dict(headers)
+        files.update({name: shm.buf[start:start + length] 
+                      for name, (start, length) in layout.items()})
+        cube = LazyCapture(paths, selection, files)
+        del files
+    fit = fit_image(cube[row_start:row_end], solver=solver, progress=False,
+                    warm_start=warm_start, previous=previous, mask=mask, grid=grid, 
+                    table=table)
+    del cube # views of shm.buf have to be gone before it is closed
+    shm.close()
+    return row_start, fit
+
+def _share_files(capture):
+    """Copies the data files of a capture received in memory into one block
+    of shared memory, once, for the pool workers to decode in place; the 
+    headers are small enough to travel with each task
+    Input: LazyCapture with files
+    Output: (SharedMemory to close and unlink once the pool is done, source
+            for _fit_tile)"""
+    data = {name: memoryview(contents).cast("B") for name, contents in capture.files.items()
+            if not name.endswith(".hdr")}
+    shm = shared_memory.SharedMemory(create=True, size=max(sum(map(len, data.values())), 1))
+    layout, position = dict(), 0
+    for name, contents in data.items():
+        shm.buf[position:position + len(contents)] = contents
+        layout[name] = (position, len(contents))
+        position += len(contents)
+    headers = {name: bytes(contents) for name, contents in capture.files.items()
+               if name.endswith(".hdr")}
+    return shm, ("files", shm.name, layout, headers, capture.paths, capture.selection)
+
+def _tile_tasks(bounds, previous, mask):
+    """Output: list of (row_start, row_end, previous, mask) of each non empty 
+            row tile between bounds"""
+    return [(start, end, None if previous is None else previous[start:end],
+             None if mask is None else mask[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def _stitch_tile(fit, row_start, tile):
+    """Copies the fit maps of a row tile into those of the whole image"""
+    rows = slice(row_start, row_start + len(tile["cost"]))
+    for key in ("params", "cost", "nfev", "status", "seed", "residual", "block"):
+        fit[key][rows] = tile[key]
+    fit["seed_nfev"] += tile["seed_nfev"]
+
+# Module settings a pool worker needs for its fits, see worker_pool
+_worker_settings = ("cold_params0", "max_plausible_T", "min_plausible_T", "kernel_backend",
+                    "lazy_frames", "saturation", "lut_dir")
+
+def _init_worker(settings, load_table):
+    """Pool initializer: a worker started by forkserver or spawn imports the 
+    module afresh, so it takes the parent's settings and maps its table"""
+    global lut
+    globals().update(settings)
+    lut = load_lut(lut_dir) if load_table else None
+
+def worker_pool(workers):
+    """Starts a pool of worker processes for fit_image_parallel. Workers are
+    started by a fork server (spawned where there is none) rather than forked
+    from the analysis process, since a fork copies any lock its other threads
+    hold at that moment. They take the module's fitting settings and lookup table
+    as they are when the pool starts, and are imported with the __main__ 
+    module, which has to guard its entry point
+    Input: number of processes
+    Output: ProcessPoolExecutor, to shut down once done with"""
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    settings = {name: globals()[name] for name in _worker_settings}
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                               initializer=_init_worker, initargs=(settings, lut is not None))
+
+def fit_image_parallel(cube, solver="pixel", workers=1, tiles_per_worker=4, 
+                       warm_start=(), previous=None, mask=None, grid=None, table=None,
+                       pool=None):
+    """Fits every pixel of a cube with a pool of worker processes, each fitting
+    a tile of rows read from shared memory, or read and corrected from disk 
+    when the cube is a LazyCapture (from the capture's files, copied into 
+    shared memory, when they were received in memory)
+    Input: cube: corrected image, in memory or a LazyCapture, which is fitted
+            lazy_frames at a time when there is a single worker, 
+            solver: "pixel" or "batched", workers: number
+            of processes, tiles_per_worker: row tiles handed to each worker, 
+            more gives better load balancing between hot and cold rows,
+            warm_start, previous, mask: as in fit_image, applied within each tile,
+            grid, table: as in fit_image; a table other than the global lut is
+            pickled to every task, pool: worker_pool of workers processes to
+            fit with, None to start one for this call
+    Output: fit maps for the cube, as from fit_image"""
+    if grid is None:
+        grid = current_grid()
+    if previous is not None and previous.shape[:2] != cube.shape[:2]:
+        previous = None
+    lazy = isinstance(cube, LazyCapture)
+    n_tiles = min(cube.shape[0], workers * tiles_per_worker)
+    if (workers <= 1 or n_tiles <= 1) and not lazy:
+        return fit_image(cube, solver=solver, warm_start=warm_start, previous=previous,
+                         mask=mask, grid=grid, table=table)
+
+    fit = empty_fit_maps(cube.shape[:2])
+    if workers <= 1 or n_tiles <= 1:
+        bounds = np.append(np.arange(0, cube.shape[0], lazy_frames), cube.shape[0])
+        for start, end, tile_previous, tile_mask in _tile_tasks(bounds, previous, mask):
+            _stitch_tile(fit, *_fit_tile(cube, start, end, solver, warm_start, 
+                                         tile_previous, tile_mask, grid, table))
+        return fit
+
+    bounds = np.linspace(0, cube.shape[0], n_tiles + 1).astype(int)
+    shm, own_pool, futures = None, pool is None, []
+    try:
+        source = cube
+        if lazy and cube.files is not None:
+            shm, source = _share_files(cube)
+        elif not lazy:
+            shm = shared_memory.SharedMemory(create=True, size=cube.nbytes)
+            shared = np.ndarray(cube.shape, dtype=cube.dtype, buffer=shm.buf)
+            shared[:] = cube
+            del shared
+            source = ("cube", shm.name, cube.shape, cube.dtype)
+
+        if own_pool:
+            pool = worker_pool(workers)
+        futures = [pool.submit(_fit_tile, source, start, end, solver, warm_start,
+                               tile_previous, tile_mask, grid,
+                               None if table is lut else table)
+                   for start, end, tile_previous, tile_mask 
+                   in _tile_tasks(bounds, previous, mask)]
+        # Collect in submission order so the stitched maps never depend 
+        # on which worker finishes first
+        for future in futures:
+            _stitch_tile(fit, *future.result())
+    except Exception as exc:
+        print(f"Parallel fitting failed ({exc}), fitting serially...")
+        return fit_image_parallel(cube, solver=solver, workers=1, warm_start=warm_start, 
+                                  previous=previous, mask=mask, grid=grid, table=table)
+    finally:
+        # A shared pool goes on to other fits, so this one's leftover tasks 
+        # are dropped from it
+        for future in futures:
+            future.cancel()
+        if own_pool and pool is not None:
+            pool.shutdown()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    return fit
+
+### Results ###
+result_params = ("a0", "a1", "a2", "offset", "T") # names of the params columns
+
+def save_result(path, fit):
+    """Saves fit maps as one compressed .npz of float32 maps, one per fit 
+    parameter (result_params) plus cost and residual, and integer maps of 
+    nfev, status, seed and block, so consumers can filter bad fits without 
+    refitting. Only pixels with status >= 0 hold usable parameters
+    Input: output path (.npz), fit maps (see empty_fit_maps)
+    Output: the path written"""
+    with open(path, "wb") as file:
+        np.savez_compressed(file, **result_arrays(fit))
+    return path
+
+def result_arrays(fit):
+    """Input: fit maps (see empty_fit_maps)
+    Output: dict of the maps save_result writes"""
+    arrays = {name: fit["params"][:, :, i].astype(np.float32) 
+              for i, name in enumerate(result_params)}
+    arrays["cost"] = fit["cost"].astype(np.float32)
+    arrays["residual"] = fit["residual"].astype(np.float32)
+    arrays["nfev"] = fit["nfev"].astype(np.int32)
+    arrays["status"] = fit["status"].astype(np.int8)
+    arrays["seed"] = fit["seed"].astype(np.int8)
+    arrays["block"] = fit["block"].astype(np.int16)
+    return arrays
+
+def load_result(path):
+    """Input: path of a file written by save_result
+    Output: dict of its maps"""
+    with np.load(path, allow_pickle=False) as result:
+        return {name: result[name] for name in result.files}
+
+def archive_capture(capture_archive, folder_path, fit=None, cube=True, files=None):
+    """Stores a capture in an archive.Archive under its folder's name, the 
+    capture timestamp: the corrected full resolution cube, read and written 
+    a block of frames at a time, with its header wavelengths, and the maps 
+    of result_arrays
+    Input: archive.Archive, path to the image folder, fit: fit maps (see 
+            empty_fit_maps), None to store only the cube, cube: store the 
+            corrected cube, files: as in open_image
+    Output: the capture's timestamp"""
+    timestamp = os.path.basename(os.path.normpath(folder_path))
+    if cube:
+        paths = construct_paths(folder_path)
+        header = capture_header(paths, files)
+        attrs = {"wavelength units": header.wavelength_units, "wavelength": 
+                 None if header.wavelength is None else header.wavelength.tolist()}
+        capture_archive.write(timestamp, "cube", LazyCapture(paths, files=files), attrs=attrs)
+    if fit is not None:
+        capture_archive.write_maps(timestamp, result_arrays(fit))
+    return timestamp
+
+### Analyzer ###
+
+class Analyzer():
+    """Runs the pyrometry analysis with its own configuration and history of 
+    previous captures instead of module globals, so several captures can be 
+    analyzed at once from different threads. Each call works on its own 
+    wavelength grid and band selection; scratch buffers for the binned image
+    are kept per thread and reused between captures of the same shape"""
+    defaults = {
+        "solver": "pixel", # see analysis
+        "workers": 1,
+        "warm_start": (),
+        "wien_emissivity": "constant",
+        "refine_above": None,
+        "pyramid_sigmas": 0.5,
+        "mask_background": True,
+        "chunk_size": 10, # pixels averaged along frames and positions
+        "band_range": None, # None for the module's band settings
+        "band_bin": None,
+        "band_exclude": None,
+        "table": None, # lookup table, None for the module's lut
+        "quiet": True,
+    }
+
+    def __init__(self, previous_fits=None, cold_nfev_reference=None, **options):
+        """Input: previous_fits: dict of capture series -> params of its 
+                latest capture (see converged_params), shared between calls;
+                None for a new one,
+                cold_nfev_reference: as in warm_start_report; None for a new
+                one, options: any of Analyzer.defaults"""
+        unknown = set(options) - set(self.defaults)
+        if unknown:
+            raise TypeError(f"Unknown Analyzer options {sorted(unknown)}")
+        self.options = dict(self.defaults, **options)
+        self.previous_fits = dict() if previous_fits is None else previous_fits
+        self.cold_nfev_reference = [0, 0] if cold_nfev_reference is None else cold_nfev_reference
+        self._lock = threading.Lock()
+        self._scratch = threading.local()
+        self._pool = None # worker_pool shared by this analyzer's fits, see _worker_pool
+        self._pool_workers = 0
+
+    def _worker_pool(self, workers):
+        """Output: this analyzer's worker_pool of the given number of processes,
+                started on first use and again if it broke or the number changed,
+                so its processes are started once for all captures"""
+        with self._lock:
+            if self._pool is not None and self._pool_workers == workers:
+                try:
+                    # Raises at once, without waiting for a busy worker, if
+                    # a worker died
+                    self._pool.submit(int)
+                    return self._pool
+                except (BrokenProcessPool, RuntimeError):
+                    pass
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool, self._pool_workers = worker_pool(workers), workers
+            return self._pool
+
+    def close(self):
+        """Shuts down the worker processes, if any; a later parallel fit 
+        starts new ones"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool, self._pool_workers = None, 0
+
+    def _options(self, overrides):
+        unknown = set(overrides) - set(self.defaults)
+        if unknown:
+            raise TypeError(f"Unknown Analyzer options {sorted(unknown)}")
+        return dict(self.options, **overrides)
+
+    def _buffer(self, shape):
+        """Output: this thread's float32 scratch array of the given shape"""
+        buffers = getattr(self._scratch, "buffers", None)
+        if buffers is None:
+            buffers = self._scratch.buffers = dict()
+        if shape not in buffers:
+            buffers.clear()
+            buffers[shape] = np.empty(shape, dtype=np.float32)
+        return buffers[shape]
+
+    def analyze(self, folder_path, full_output=False, files=None, **overrides):
+        """Analyzes the capture in the given folder
+        Input: path to the image folder, full_output: also return the capture,
+                files: contents of the capture's files received in memory 
+                (see open_image), None to read them from the folder,
+                overrides: options for this call only (see Analyzer.defaults)
+        Output: fit maps (see empty_fit_maps), or "FAIL" if the image failed
+                to load; with full_output, (fit maps, capture dict as from 
+                analyze_cube)"""
+        options = self._options(overrides)
+        paths = construct_paths(folder_path)
+        chunk_size = 1 if options["solver"] == "pyramid" else options["chunk_size"]
+        bins = None if chunk_size == 1 else (chunk_size, chunk_size, 1)
+        try:
+            header = capture_header(paths, files)
+            header_wavelengths, header_units, block = read_header_bands(paths[0], header)
+            out = None
+            if bins is not None:
+                out = self._buffer(binned_shape(header.shape, bins))
+            # At full resolution the image stays on disk (or in the received
+            # files) until it is fitted
+            cube, noise = read_capture(paths, bins, out=out, lazy=True, files=files)
+        except Exception:
+            print("Load failed, waiting 30 seconds...")
+            sleep(30)
+            return "FAIL"
+
+        # Captures of one growth are saved side by side, so the parent folder 
+        # identifies the series whose previous capture can seed this one
+        series = os.path.dirname(os.path.abspath(folder_path))
+        return self.analyze_cube(cube, header_wavelengths, units=header_units, noise=noise,
+                                 averaged=chunk_size**2, series=series, 
+                                 grid_block=block, full_output=full_output, **options)
+
+    def analyze_stream(self, folder_path, poll=0.5, timeout=30, **overrides):
+        """Analyzes a capture while the camera is still writing it, fitting 
+        each block of frames as soon as it has arrived (see stream_frames).
+        The hot region mask compares pixels with the brightest one seen so
+        far instead of the whole image's, and warm starts stay within a block
+        Input: path to the image folder, poll, timeout: as in stream_frames,
+                overrides: options for this call only (see Analyzer.defaults);
+                any solver but "pyramid", which needs the whole image
+        Output: generator of (first row, fit maps of the block's rows), rows
+                counted after averaging chunk_size frames"""
+        options = self._options(overrides)
+        solver, warm_start = options["solver"], tuple(options["warm_start"])
+        if solver == "pyramid":
+            raise ValueError("The pyramid solver needs the whole image and cannot be streamed")
+        table = lut if options["table"] is None else options["table"]
+        paths = construct_paths(folder_path)
+        chunk_size = options["chunk_size"]
+        bins = (chunk_size, chunk_size, 1)
+        step = max(lazy_frames // chunk_size, 1) * chunk_size
+
+        if not wait_for(paths[0], poll, timeout):
+            return
+        header_wavelengths, header_units, block = read_header_bands(paths[0])
+        if header_units != "nm":
+            raise ValueError(f"Wavelength units are {header_units}, expected nm")
+        selection = select_bands(header_wavelengths, options["band_range"], 
+                                 options["band_bin"], options["band_exclude"])
+        frames = stream_frames(paths, poll=poll, timeout=timeout, 
+                               valid_bands=selection["index"])
+        first = next(frames, None)
+        if first is None:
+            return
+        grid = cached_grid(selection["wavelengths"], key=grid_key(block, selection))
+        band_noise = np.sqrt(apply_bands(read_references(paths)["noise"]**2, 
+                                         selection) / selection["counts"])
+        if (solver == "lut" or "lut" in warm_start) and not lut_usable(table, grid):
+            print(f"No lookup table for this wavelength grid in {lut_dir}, skipping it...")
+            if solver == "lut":
+                solver = "batched"
+
+        series = os.path.dirname(os.path.abspath(folder_path))
+        with self._lock:
+            previous = self.previous_fits.get(series)
+        row, brightest, params = 0, 0, []
+        for cube in frame_batches([first], frames, step=step):
+            cube = apply_bands(cube, selection)
+            if chunk_size > 1:
+                cube = bin_cube(cube, bins)
+
+            mask = None
+            if options["mask_background"]:
+                brightest = max(brightest, np.nanmax(np.sum(cube, axis=2)))
+                mask = hot_mask(cube, band_noise, averaged=chunk_size**2, quiet=True, 
+                                grid=grid, brightest=brightest)
+            if solver == "wien":
+                valid = valid_pixels(cube)
+                fit = fit_wien_image(cube, emissivity=options["wien_emissivity"], 
+                                     refine_above=options["refine_above"], 
+                                     mask=valid if mask is None else mask & valid, grid=grid)
+                fit = skip_invalid(fit, valid)
+            else:
+                fit = fit_image(cube, solver=solver, progress=False, warm_start=warm_start,
+                                previous=None if previous is None else previous[row:row + len(cube)],
+                                mask=mask, grid=grid, table=table)
+            params.append(converged_params(fit))
+            yield row, fit
+            row += len(cube)
+
+        with self._lock:
+            self.previous_fits[series] = np.concatenate(params)
+
+    def analyze_cube(self, cube, header_wavelengths, units="nm", noise=None, averaged=1,
+                     series=None, grid_block=None, full_output=False, **overrides):
+        """Fits a corrected cube already in memory or a LazyCapture
+        Input: (frames, positions, header bands) corrected cube, wavelengths 
+                of its bands in nm, units: checked to be nm, noise: per band
+                noise of one corrected pixel (see dark_noise), None to skip 
+                the SNR test of hot_mask, averaged: pixels averaged into each
+                cube pixel, series: key of the capture series for "previous"
+                warm starts, None to neither use nor record one, grid_block: 
+                wavelength key from read_header_bands, to share cached grids, 
+                full_output: also return the capture, overrides: options for
+                this call only (see Analyzer.defaults)
+        Output: fit maps (see empty_fit_maps); with full_output, (fit maps, 
+                dict of the fitted image, grid, units, band selection and noise)"""
+        options = self._options(overrides)
+        if units != "nm":
+            raise ValueError(f"Wavelength units are {units}, expected nm")
+        solver, warm_start = options["solver"], tuple(options["warm_start"])
+        table = lut if options["table"] is None else options["table"]
+
+        selection = select_bands(header_wavelengths, options["band_range"], 
+                                 options["band_bin"], options["band_exclude"])
+        if grid_block is None:
+            grid_block = np.asarray(header_wavelengths).tobytes().hex()
+        grid = cached_grid(selection["wavelengths"], key=grid_key(grid_block, selection))
+        cube = apply_bands(cube, selection)
+        if isinstance(cube, LazyCapture) and solver not in ("pixel", "batched"):
+            # Only the pixel and batched fits read the image a tile at a time
+            cube = np.asarray(cube)
+
+        # Skip the chamber wall and cold rod, which are too dark to measure
+        mask, band_noise = None, None
+        if noise is not None:
+            band_noise = np.sqrt(apply_bands(np.asarray(noise)**2, selection) / selection["counts"])
+        if options["mask_background"]:
+            mask = hot_mask(cube, band_noise, averaged=averaged, quiet=options["quiet"], grid=grid)
+
+        if (solver == "lut" or "lut" in warm_start) and not lut_usable(table, grid):
+            print(f"No lookup table for this wavelength grid in {lut_dir}, skipping it...")
+            if solver == "lut":
+                solver = "batched"
+
+        with self._lock:
+            previous = None if series is None else self.previous_fits.get(series)
+        valid = None
+        if solver in ("wien", "pyramid"):
+            # The other solvers leave pixels blanked by correct_frames to fit_image
+            valid = valid_pixels(cube)
+            mask = valid if mask is None else mask & valid
+        if solver == "wien":
+            fit = fit_wien_image(cube, emissivity=options["wien_emissivity"], 
+                                 refine_above=options["refine_above"], mask=mask, grid=grid)
+            print(f"Wien estimate median RMS log residual: {np.nanmedian(fit['residual']):.3g}")
+        elif solver == "pyramid":
+            pixel_noise = None if band_noise is None else band_noise / np.sqrt(averaged)
+            fit = fit_pyramid(cube, T_sigmas=options["pyramid_sigmas"], noise=pixel_noise, 
+                              mask=mask, quiet=options["quiet"], grid=grid)
+        else:
+            pool = self._worker_pool(options["workers"]) if options["workers"] > 1 else None
+            fit = fit_image_parallel(cube, solver=solver, workers=options["workers"], 
+                                     warm_start=warm_start, previous=previous, mask=mask,
+                                     grid=grid, table=table, pool=pool)
+        if valid is not None:
+            fit = skip_invalid(fit, valid)
+
+        with self._lock:
+            if len(warm_start) > 0:
+                _ = warm_start_report(fit, reference=self.cold_nfev_reference)
+            if series is not None:
+                self.previous_fits[series] = converged_params(fit)
+
+        if full_output:
+            return fit, {"image": cube, "grid": grid, "units": units, 
+                         "band_selection": selection, "noise": noise}
+        return fit
+
+def temperature_map(fit):
+    """Input: fit maps (see empty_fit_maps)
+    Output: fitted temperatures, with -1 where the fit failed and background 
+            where the pixel was skipped"""
+    return np.where(fit["status"] >= 0, fit["params"][:, :, -1], 
+                    np.where(fit["status"] == background, background, -1))
+
+def analysis(folder_path, solver="pixel", workers=1, warm_start=(), 
+             wien_emissivity="constant", refine_above=None, pyramid_sigmas=0.5,
+             mask_background=True):
     """Runs pyrometry analysis on the hyperspectral image contained in the given
-    folder path
-    Input: path to the image folder
-    Output: temperature gradient array for the image"""
+    folder path, with the module's band settings and history through 
+    default_analyzer; use an Analyzer directly to run several at once
+    Input: path to the image folder, solver: "pixel" to run fit_spectrum on each
+            pixel in turn, "batched" to fit every pixel together with fit_batch,
+            "wien" for the fast closed-form estimate of fit_wien or "lut" for 
+            the lookup table estimate of fit_lut (see build_lut) or "pyramid"
+            to fit the full resolution image coarse to fine with fit_pyramid
+            instead of blurring it,
+            workers: number of processes to split the image's rows between,
+            warm_start: seed sources for the fits (see fit_image), e.g. 
+            ("previous", "lut", "neighbor"); empty for cold starts only,
+            wien_emissivity, refine_above: options of the "wien" solver (see
+            fit_wien_image), pyramid_sigmas: T_sigmas of the "pyramid" solver,
+            mask_background: fit only the pixels hot_mask finds hot enough
+    Output: temperature gradient array for the image, with -1 where the fit 
+            failed and background where the pixel was skipped; the full fit 
+            maps are kept in fit_result (see save_result)"""
     global folder
     global image
-    global pixel
-    global spectrum
     global temp_arr
+    global fit_result
+    global wavelengths
+    global grid
+    global units
+    global band_selection
+    global dark_noise
 
     folder = folder_path
-
-    paths = construct_paths(folder)
-    image = load_data(paths, quiet=True)
+    result = default_analyzer.analyze(
+        folder_path, full_output=True, solver=solver, workers=workers, 
+        warm_start=warm_start, wien_emissivity=wien_emissivity, 
+        refine_above=refine_above, pyramid_sigmas=pyramid_sigmas, mask_background=mask_background,
+        quiet=False)
 
     # Do not attempt further analysis if the image failed to load
-    if type(image) == str:
+    if type(result) == str:
         return "FAIL"
-    _ = get_bands(paths, quiet=True)
-
-    # Blur the image to save time
-    _ = shrink_image()
-
-    # Fit every pixel of the blurred image
-    temp_arr = np.zeros((image.shape[0], image.shape[1]))
-    for (i,j) in itertools.product(range(image.shape[0]), range(image.shape[1])):
-        # [:339] removes wavelengths 950 to 1000 nm since stray laser light 
-        # amplifies intensities at those wavelengths, so we wish to ignore them in 
-        # the fitting
-        spectrum = image[i][j][:339]
-        try:
-            result, cost = fit_spectrum(quiet=True, check_units=False)
-            temp_arr[i][j] = result[-1]
-        except: temp_arr[i][j] = -1
-    
+    fit_result, capture = result
+    image, grid, units = capture["image"], capture["grid"], capture["units"]
+    wavelengths = grid.nm
+    band_selection, dark_noise = capture["band_selection"], capture["noise"]
+
+    temp_arr = temperature_map(fit_result)
     return temp_arr
 
+# Shares the module's history of previous captures, so analysis() keeps 
+# warm starting from them
+default_analyzer = Analyzer(previous_fits=previous_fits, 
+                            cold_nfev_reference=cold_nfev_reference)
+
 if __name__ == "__main__": print("This file should not be run directly...")
\ No newline at end of file
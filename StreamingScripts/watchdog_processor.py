@@ -97,7 +97,7 @@ class Watcher:
 class Handler(FileSystemEventHandler):
     @staticmethod
     def on_created(event):
-        if event.src_path[-4:] == ".npy" or event.src_path[-4:] == ".log":
+        if event.src_path[-4:] == ".npz" or event.src_path[-4:] == ".log":
             return
         if isinstance(event, DirCreatedEvent):
             print(f"Watchdog found {event.src_path} directory created...")
@@ -115,7 +115,7 @@ class Handler(FileSystemEventHandler):
 
         foldername = rootdir[rootdir.rfind("/")+1:]
         print(foldername)
-        output_filepath = rootdir + "/" + foldername + ".npy"
+        output_filepath = rootdir + "/" + foldername + ".npz"
 
         if not (
             "whiteReference" in files
@@ -127,7 +127,7 @@ class Handler(FileSystemEventHandler):
             and "data" in files
             and "data.hdr" in files
             and "frameIndex.txt" in files
-            and foldername + ".npy" not in files
+            and foldername + ".npz" not in files
         ): return
 
         folder_path = str(RECO_DIR / foldername)
@@ -135,7 +135,7 @@ class Handler(FileSystemEventHandler):
         while type(temp_arr) == str:
             temp_arr = temperature_analysis.analysis(folder_path)
         
-        np.save(output_filepath, temp_arr, allow_pickle=True)
+        temperature_analysis.save_result(output_filepath, temperature_analysis.fit_result)
         upload_file = UploadDataFile(pathlib.Path(output_filepath), rootdir=rootdir)
         upload_file.upload_whole_file(CONFIG_FILE_PATH, TOPIC_NAME)
 